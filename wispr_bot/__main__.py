@@ -2,6 +2,13 @@ import asyncio
 import os
 from pathlib import Path
 
+# Use uvloop when available (not on Windows) for a faster event loop
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Create logs directory if doesn't exist
 Path("logs").mkdir(exist_ok=True)
 
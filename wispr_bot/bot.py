@@ -1,14 +1,18 @@
 import asyncio
+import orjson
 from aiogram import Bot, Dispatcher
-from aiogram.types import Message, BotCommand
-from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.types import BotCommand
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
 from .utils.logger import logger
 from .config import config
 from .database.db import db
 from .middlewares.access import AccessMiddleware
-from .routers import admin, settings, chats, images
+from .routers import admin, commands, settings, chats, images
+from .services import openai_service
 
 
 async def set_commands(bot: Bot) -> None:
@@ -28,12 +32,73 @@ async def set_commands(bot: Bot) -> None:
     await bot.set_my_commands(commands)
 
 
+async def run_webhook(dp: Dispatcher, bot: Bot) -> None:
+    """Serve updates over a webhook instead of long polling.
+
+    Telegram pushes updates to us with no polling latency and fans
+    deliveries out concurrently into the aiohttp worker.
+    """
+    webhook_path = f"/webhook/{config.bot_token}"
+    secret_token = config.webhook_secret or None
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret_token
+    ).register(app, path=webhook_path)
+    setup_application(app, dp, bot=bot)
+
+    await bot.set_webhook(
+        url=f"{config.webhook_base_url}{webhook_path}",
+        allowed_updates=["message", "callback_query"],
+        secret_token=secret_token,
+        drop_pending_updates=True,
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.webhook_host, config.webhook_port)
+    await site.start()
+    logger.info(f"Webhook server listening on {config.webhook_host}:{config.webhook_port}")
+
+    try:
+        # Serve until the task is cancelled
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
 async def start_bot() -> None:
     """Initialize and start the bot."""
     # Initialize storage and dispatcher
     storage = MemoryStorage()
     dp = Dispatcher(storage=storage)
-    bot = Bot(token=config.bot_token)
+
+    # Use orjson for (de)serializing every Telegram API payload, and a
+    # connector sized for burst traffic so TLS handshakes to
+    # api.telegram.org are reused instead of re-established
+    session = AiohttpSession(
+        limit=256,
+        json_loads=orjson.loads,
+        json_dumps=lambda value: orjson.dumps(value).decode(),
+    )
+    # Keep-alive tuning is not exposed by aiogram's constructor; it feeds
+    # these straight into the TCPConnector it builds (DNS cache is already
+    # enabled there). Атрибут приватный, поэтому доступ защищён: если
+    # новая aiogram его переименует, бот стартует без тюнинга вместо
+    # падения с AttributeError
+    connector_init = getattr(session, "_connector_init", None)
+    if connector_init is not None:
+        connector_init.update(
+            limit_per_host=64,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True,
+        )
+    else:
+        logger.warning(
+            "AiohttpSession no longer exposes _connector_init; "
+            "skipping keep-alive tuning"
+        )
+    bot = Bot(token=config.bot_token, session=session)
     
     # Register middlewares
     dp.message.middleware.register(AccessMiddleware())
@@ -41,37 +106,11 @@ async def start_bot() -> None:
     
     # Register routers
     dp.include_router(admin.router)
+    dp.include_router(commands.router)
     dp.include_router(settings.router)
     dp.include_router(images.router)
     dp.include_router(chats.router)
-    
-    # Register basic commands
-    @dp.message(Command("start"))
-    async def cmd_start(message: Message) -> None:
-        """Handle /start command."""
-        await message.answer(
-            f"👋 Добро пожаловать в Wispr Bot!\n\n"
-            f"Я Telegram бот, который позволяет общаться с моделями OpenAI.\n\n"
-            f"Используйте /help чтобы увидеть доступные команды."
-        )
-    
-    @dp.message(Command("help"))
-    async def cmd_help(message: Message) -> None:
-        """Handle /help command."""
-        help_text = (
-            "🔍 Доступные команды:\n\n"
-            "/newchat - Создать новый чат\n"
-            "/chats - Показать все чаты\n"
-            "/currentchat - Информация о текущем чате\n"
-            "/clear_history - Очистить историю текущего чата\n"
-            "/exit - Выйти из текущего чата\n"
-            "/image - Создать изображение по описанию\n"
-            "/settings - Настройки\n"
-            "/help - Показать справку\n\n"
-            "Просто отправьте сообщение, чтобы начать общение!"
-        )
-        await message.answer(help_text)
-    
+
     # Connect to database
     try:
         await db.connect()
@@ -84,12 +123,26 @@ async def start_bot() -> None:
     
     try:
         logger.info("Starting bot...")
-        await dp.start_polling(bot, skip_updates=True)
+        if config.bot_mode == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # Only ask Telegram for the update types we handle, and hold the
+            # long-poll open for the maximum window to cut idle getUpdates traffic
+            await dp.start_polling(
+                bot,
+                skip_updates=True,
+                allowed_updates=["message", "callback_query"],
+                polling_timeout=30,
+            )
     except Exception as e:
         logger.error(f"Error during bot execution: {e}")
     finally:
         logger.info("Stopping bot...")
+        await images.close_session()
+        await openai_service.close_http_session()
         await db.disconnect()
+        # Flush records still queued in the background logging thread
+        await logger.complete()
 
 
 if __name__ == "__main__":
@@ -1,34 +1,95 @@
 import os
-from typing import List, Set
+from typing import FrozenSet, List
 from pathlib import Path
 from dotenv import load_dotenv
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, model_validator
 
 # Load environment variables
 BASE_DIR = Path(__file__).resolve().parent
 load_dotenv(BASE_DIR / ".env")
 
 
+def _parse_admin_user_ids() -> FrozenSet[int]:
+    """Parse ADMIN_USER_IDS into a frozenset once per Config construction."""
+    return frozenset(
+        int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x
+    )
+
+
+def _parse_available_models() -> List[str]:
+    """Parse AVAILABLE_MODELS into a list once per Config construction."""
+    return os.getenv("AVAILABLE_MODELS", "gpt-3.5-turbo").split(",")
+
+
 class Config(BaseModel):
     """Application configuration settings."""
-    
+
     # Bot settings
-    bot_token: str = os.getenv("BOT_TOKEN", "")
-    admin_user_ids: Set[int] = {
-        int(x) for x in os.getenv("ADMIN_USER_IDS", "").split(",") if x
-    }
-    
+    bot_token: str = Field(default_factory=lambda: os.getenv("BOT_TOKEN", ""))
+    admin_user_ids: FrozenSet[int] = Field(default_factory=_parse_admin_user_ids)
+
+    # Update delivery: "polling" (default) or "webhook" for high-QPS deployments
+    bot_mode: str = Field(default_factory=lambda: os.getenv("BOT_MODE", "polling"))
+    webhook_base_url: str = Field(default_factory=lambda: os.getenv("WEBHOOK_BASE_URL", ""))
+    webhook_host: str = Field(default_factory=lambda: os.getenv("WEBHOOK_HOST", "0.0.0.0"))
+    webhook_port: int = Field(default_factory=lambda: int(os.getenv("WEBHOOK_PORT", "8080")))
+    webhook_secret: str = Field(default_factory=lambda: os.getenv("WEBHOOK_SECRET", ""))
+
     # Database settings
-    database_url: str = os.getenv("DATABASE_URL", "")
-    
+    database_url: str = Field(default_factory=lambda: os.getenv("DATABASE_URL", ""))
+    db_pool_min_size: int = Field(
+        default_factory=lambda: int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+    )
+    db_pool_max_size: int = Field(
+        default_factory=lambda: int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+    )
+    db_pool_timeout: float = Field(
+        default_factory=lambda: float(os.getenv("DB_POOL_TIMEOUT", "10"))
+    )
+    db_statement_cache_size: int = Field(
+        default_factory=lambda: int(os.getenv("DB_STATEMENT_CACHE_SIZE", "1024"))
+    )
+
     # OpenAI settings
-    openai_api_key: str = os.getenv("OPENAI_API_KEY", "")
-    available_models: List[str] = os.getenv("AVAILABLE_MODELS", "gpt-3.5-turbo").split(",")
-    default_model: str = available_models[0] if available_models else "gpt-3.5-turbo"
-    
+    openai_api_key: str = Field(default_factory=lambda: os.getenv("OPENAI_API_KEY", ""))
+    available_models: List[str] = Field(default_factory=_parse_available_models)
+    # Frozen view of available_models for O(1) membership checks on the
+    # per-request validation paths
+    available_models_set: FrozenSet[str] = frozenset()
+    default_model: str = ""
+    # Cap on simultaneous streaming requests to OpenAI across all users
+    max_concurrent_streams: int = Field(
+        default_factory=lambda: int(os.getenv("MAX_CONCURRENT_STREAMS", "32"))
+    )
+    # Caps on simultaneous non-streaming chat completions and image
+    # generations; size these to the account's rate-limit tier
+    max_concurrent_chat: int = Field(
+        default_factory=lambda: int(os.getenv("MAX_CONCURRENT_CHAT", "8"))
+    )
+    max_concurrent_image: int = Field(
+        default_factory=lambda: int(os.getenv("MAX_CONCURRENT_IMAGE", "4"))
+    )
+    # Client-side rate budget for chat completions; match the account tier
+    max_requests_per_minute: int = Field(
+        default_factory=lambda: int(os.getenv("OPENAI_MAX_RPM", "500"))
+    )
+    max_tokens_per_minute: int = Field(
+        default_factory=lambda: int(os.getenv("OPENAI_MAX_TPM", "200000"))
+    )
+
     # Logging
-    log_level: str = os.getenv("LOG_LEVEL", "INFO")
+    log_level: str = Field(default_factory=lambda: os.getenv("LOG_LEVEL", "INFO"))
+
+    @model_validator(mode="after")
+    def _derive_default_model(self) -> "Config":
+        """Derive default_model from the parsed model list, not the raw default."""
+        if not self.default_model:
+            self.default_model = (
+                self.available_models[0] if self.available_models else "gpt-3.5-turbo"
+            )
+        self.available_models_set = frozenset(self.available_models)
+        return self
 
 
 # Create config instance
-config = Config() 
\ No newline at end of file
+config = Config()
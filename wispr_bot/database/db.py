@@ -1,6 +1,8 @@
 import asyncpg
+import orjson
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional
 from datetime import datetime
 
 from ..utils.logger import logger
@@ -9,24 +11,181 @@ from ..models.user import User
 from ..models.chat import Chat, ChatMessage
 
 
+# Hot SQL statements as module-level constants so asyncpg's per-connection
+# statement cache keys hit on the same text every call.
+SQL_GET_USER = """
+    SELECT * FROM users WHERE telegram_id = $1
+"""
+
+SQL_GET_USERS_BY_IDS = """
+    SELECT * FROM users WHERE telegram_id = ANY($1::bigint[])
+"""
+
+SQL_UPSERT_USER = """
+    INSERT INTO users (telegram_id, username, first_name, last_name, is_allowed)
+    VALUES ($1, $2, $3, $4, $5)
+    ON CONFLICT (telegram_id)
+    DO UPDATE SET
+        username = $2,
+        first_name = $3,
+        last_name = $4,
+        last_active = NOW()
+    RETURNING *
+"""
+
+SQL_TOUCH_USER = """
+    UPDATE users SET last_active = NOW() WHERE telegram_id = $1
+"""
+
+SQL_ADD_MESSAGE_CTE = """
+    WITH m AS (
+        INSERT INTO messages (chat_id, role, content)
+        VALUES ($1, $2, $3)
+    )
+    UPDATE chats
+    SET updated_at = NOW(), message_count = message_count + 1
+    WHERE id = $1
+"""
+
+SQL_GET_CHAT = """
+    SELECT c.*,
+           COALESCE(
+               json_agg(
+                   json_build_object(
+                       'role', m.role,
+                       'content', m.content,
+                       'timestamp', m.timestamp
+                   ) ORDER BY m.timestamp
+               ) FILTER (WHERE m.id IS NOT NULL),
+               '[]'
+           ) AS messages
+    FROM chats c
+    LEFT JOIN messages m ON m.chat_id = c.id
+    WHERE c.id = $1
+    GROUP BY c.id
+"""
+
+SQL_GET_CONTEXT_MESSAGES = """
+    SELECT role, content, timestamp FROM messages
+    WHERE chat_id = $1
+      AND NOT (role = 'assistant' AND content LIKE '⚠️ Ошибка%')
+    ORDER BY timestamp DESC
+    LIMIT $2
+"""
+
+SQL_GET_USER_CHATS = """
+    SELECT id, title, model, created_at, updated_at
+    FROM chats
+    WHERE user_id = $1
+    ORDER BY updated_at DESC
+"""
+
+SQL_GET_USER_CHATS_SUMMARY = """
+    SELECT c.id, c.title, c.model, c.created_at,
+           c.message_count AS msg_count,
+           count(*) OVER () AS total
+    FROM chats c
+    WHERE c.user_id = $1
+    ORDER BY c.updated_at DESC
+    LIMIT $2 OFFSET $3
+"""
+
+SQL_GET_CHAT_SUMMARY = """
+    SELECT c.id, c.user_id, c.title, c.model, c.created_at,
+           c.message_count AS msg_count
+    FROM chats c
+    WHERE c.id = $1
+"""
+
+
+async def _prepare_hot_statements(conn: asyncpg.Connection) -> None:
+    """Warm a pooled connection by preparing the hottest statements.
+
+    asyncpg caches prepared statements per connection keyed by SQL text;
+    preparing on connect removes first-call parse/plan latency.
+    """
+    for sql in (
+        SQL_GET_USER,
+        SQL_GET_USERS_BY_IDS,
+        SQL_UPSERT_USER,
+        SQL_TOUCH_USER,
+        SQL_ADD_MESSAGE_CTE,
+        SQL_GET_CHAT,
+        SQL_GET_CONTEXT_MESSAGES,
+        SQL_GET_USER_CHATS,
+        SQL_GET_USER_CHATS_SUMMARY,
+        SQL_GET_CHAT_SUMMARY,
+    ):
+        await conn.prepare(sql)
+
+
+def _invalidate_user_cache(telegram_id: int) -> None:
+    """Drop a user from the middleware's in-process cache after an update."""
+    # Imported lazily to avoid a circular import with the middleware package.
+    from ..middlewares.access import AccessMiddleware
+    AccessMiddleware.invalidate_user(telegram_id)
+
+
 class Database:
     """Database manager for PostgreSQL operations."""
     
     def __init__(self):
         self.pool = None
-    
+        self._listen_conn = None
+
     async def connect(self) -> None:
         """Connect to PostgreSQL database."""
         try:
-            self.pool = await asyncpg.create_pool(config.database_url)
+            self.pool = await asyncpg.create_pool(
+                config.database_url,
+                min_size=config.db_pool_min_size,
+                max_size=config.db_pool_max_size,
+                timeout=config.db_pool_timeout,
+                statement_cache_size=config.db_statement_cache_size,
+                init=_prepare_hot_statements,
+            )
             logger.info("Connected to database")
             await self._initialize_database()
+            await self._start_invalidation_listener()
         except Exception as e:
             logger.error(f"Error connecting to database: {e}")
             raise
+
+    async def _start_invalidation_listener(self) -> None:
+        """Listen for cross-process user-cache invalidation events.
+
+        Every replica holds one dedicated connection on LISTEN, so an
+        admin updating a user on one worker instantly drops the stale
+        entry from every worker's in-process cache.
+        """
+        self._listen_conn = await asyncpg.connect(config.database_url)
+        await self._listen_conn.add_listener(
+            "user_invalidated", self._on_user_invalidated
+        )
+
+    def _on_user_invalidated(self, conn, pid, channel, payload) -> None:
+        """NOTIFY callback: drop the user from this process's cache."""
+        try:
+            _invalidate_user_cache(int(payload))
+        except (TypeError, ValueError):
+            logger.warning(f"Ignoring malformed invalidation payload: {payload!r}")
     
+    @asynccontextmanager
+    async def transaction(self):
+        """Acquire one connection and run the block inside a transaction.
+
+        Use this for logically-atomic multi-statement operations so they
+        share a single pooled connection instead of acquiring twice.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                yield conn
+
     async def disconnect(self) -> None:
         """Disconnect from PostgreSQL database."""
+        if self._listen_conn:
+            await self._listen_conn.close()
+            self._listen_conn = None
         if self.pool:
             await self.pool.close()
             logger.info("Disconnected from database")
@@ -44,22 +203,58 @@ class Database:
             logger.error(f"Error initializing database schema: {e}")
             raise
 
+    @staticmethod
+    async def _notify_user_invalidated(conn: asyncpg.Connection, telegram_id: int) -> None:
+        """Broadcast a user-cache invalidation to all listening replicas."""
+        await conn.execute(
+            "SELECT pg_notify('user_invalidated', $1)", str(telegram_id)
+        )
+
     # User operations
     async def get_user(self, telegram_id: int) -> Optional[User]:
         """Get user by Telegram ID."""
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT * FROM users WHERE telegram_id = $1
-                """, 
-                telegram_id
-            )
+            row = await conn.fetchrow(SQL_GET_USER, telegram_id)
             
             if not row:
                 return None
-                
-            return User(**dict(row))
+
+            # Row values are already typed by asyncpg; skip re-validation
+            return User.model_construct(**dict(row))
     
+    async def get_users_by_ids(self, telegram_ids: List[int]) -> List[User]:
+        """Get several users by Telegram ID in one query."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(SQL_GET_USERS_BY_IDS, telegram_ids)
+            return [User.model_construct(**dict(row)) for row in rows]
+
+    async def upsert_user_returning(
+        self,
+        telegram_id: int,
+        username: Optional[str] = None,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None,
+        is_allowed: bool = False,
+    ) -> User:
+        """Create or refresh a user in a single round-trip and return the row.
+
+        Collapses the SELECT + INSERT-or-UPDATE pair into one statement.
+        On conflict only the profile fields and last_active are refreshed,
+        so is_allowed/api key/model set by admins are preserved.
+        """
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                SQL_UPSERT_USER,
+                telegram_id, username, first_name, last_name, is_allowed
+            )
+
+            return User.model_construct(**dict(row))
+
+    async def touch_user_last_active(self, telegram_id: int) -> None:
+        """Refresh only last_active, skipping the full-row rewrite."""
+        async with self.pool.acquire() as conn:
+            await conn.execute(SQL_TOUCH_USER, telegram_id)
+
     async def create_or_update_user(self, user: User) -> User:
         """Create or update user."""
         async with self.pool.acquire() as conn:
@@ -67,8 +262,8 @@ class Database:
                 """
                 INSERT INTO users 
                 (telegram_id, username, first_name, last_name, is_allowed, openai_api_key, preferred_model, created_at, last_active)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-                ON CONFLICT (telegram_id) 
+                VALUES ($1, $2, $3, $4, $5, $6, $7, COALESCE($8, NOW()), COALESCE($9, NOW()))
+                ON CONFLICT (telegram_id)
                 DO UPDATE SET
                     username = $2,
                     first_name = $3,
@@ -76,7 +271,7 @@ class Database:
                     is_allowed = $5,
                     openai_api_key = $6,
                     preferred_model = $7,
-                    last_active = $9
+                    last_active = COALESCE($9, NOW())
                 """,
                 user.telegram_id, user.username, user.first_name, user.last_name,
                 user.is_allowed, user.openai_api_key, user.preferred_model,
@@ -94,7 +289,9 @@ class Database:
                 """,
                 is_allowed, telegram_id
             )
-    
+            await self._notify_user_invalidated(conn, telegram_id)
+        _invalidate_user_cache(telegram_id)
+
     async def update_user_api_key(self, telegram_id: int, api_key: Optional[str]) -> None:
         """Update user's OpenAI API key."""
         async with self.pool.acquire() as conn:
@@ -104,7 +301,9 @@ class Database:
                 """,
                 api_key, telegram_id
             )
-    
+            await self._notify_user_invalidated(conn, telegram_id)
+        _invalidate_user_cache(telegram_id)
+
     async def update_user_preferred_model(self, telegram_id: int, model: str) -> None:
         """Update user's preferred ChatGPT model."""
         async with self.pool.acquire() as conn:
@@ -114,12 +313,14 @@ class Database:
                 """,
                 model, telegram_id
             )
+            await self._notify_user_invalidated(conn, telegram_id)
+        _invalidate_user_cache(telegram_id)
     
     async def get_allowed_users(self) -> List[User]:
         """Get all allowed users."""
         async with self.pool.acquire() as conn:
             rows = await conn.fetch("SELECT * FROM users WHERE is_allowed = TRUE")
-            return [User(**dict(row)) for row in rows]
+            return [User.model_construct(**dict(row)) for row in rows]
     
     # Chat operations
     async def create_chat(self, user_id: int, title: str, model: str, system_prompt: Optional[str] = None) -> Chat:
@@ -144,28 +345,20 @@ class Database:
             )
     
     async def get_chat(self, chat_id: int) -> Optional[Chat]:
-        """Get chat by ID with messages."""
+        """Get chat by ID with messages in a single round-trip."""
         async with self.pool.acquire() as conn:
-            # Get chat details
-            chat_row = await conn.fetchrow("SELECT * FROM chats WHERE id = $1", chat_id)
+            # Chat row and JSON-aggregated messages come back together
+            chat_row = await conn.fetchrow(SQL_GET_CHAT, chat_id)
             if not chat_row:
                 return None
-                
+
             chat_dict = dict(chat_row)
-            
-            # Get chat messages
-            message_rows = await conn.fetch(
-                """
-                SELECT role, content, timestamp FROM messages 
-                WHERE chat_id = $1 
-                ORDER BY timestamp ASC
-                """, 
-                chat_id
-            )
-            
-            messages = [ChatMessage(**dict(row)) for row in message_rows]
-            
-            return Chat(
+
+            messages = [
+                ChatMessage(**msg) for msg in orjson.loads(chat_dict["messages"])
+            ]
+
+            return Chat.model_construct(
                 id=chat_dict["id"],
                 user_id=chat_dict["user_id"],
                 title=chat_dict["title"],
@@ -176,41 +369,92 @@ class Database:
                 system_prompt=chat_dict["system_prompt"]
             )
     
-    async def get_user_chats(self, user_id: int) -> List[Dict[str, Any]]:
-        """Get all chats for a user (without messages for performance)."""
+    async def get_chat_context_messages(self, chat_id: int, limit: int = 20) -> List[ChatMessage]:
+        """Get the most recent non-error messages for the OpenAI context.
+
+        Error replies are filtered out server-side so they never get
+        materialized in Python. Returned newest-first (reverse before use).
+        """
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT id, title, model, created_at, updated_at 
-                FROM chats 
-                WHERE user_id = $1
-                ORDER BY updated_at DESC
-                """, 
-                user_id
-            )
-            
-            return [dict(row) for row in rows]
+            rows = await conn.fetch(SQL_GET_CONTEXT_MESSAGES, chat_id, limit)
+            return [ChatMessage.model_construct(**dict(row)) for row in rows]
+
+    async def get_user_chats(self, user_id: int) -> List[asyncpg.Record]:
+        """Get all chats for a user (without messages for performance).
+
+        Records are returned as-is: they support keyed access like dicts
+        but are C-level objects, so no per-row dict copy is needed.
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(SQL_GET_USER_CHATS, user_id)
+
+    async def get_user_chats_summary(
+        self, user_id: int, limit: int = 10, offset: int = 0
+    ) -> List[asyncpg.Record]:
+        """Get a page of the user's most recent chats with message counts.
+
+        One prepared statement for the list views: no message-list
+        hydration, and a window count gives the user's total chat count
+        without a second query. Rows carry id, title, model, created_at,
+        msg_count and total.
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(SQL_GET_USER_CHATS_SUMMARY, user_id, limit, offset)
+
+    async def get_chat_summary(self, chat_id: int) -> Optional[asyncpg.Record]:
+        """Get a single chat's metadata and message count, without messages."""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(SQL_GET_CHAT_SUMMARY, chat_id)
     
     async def add_message(self, chat_id: int, role: str, content: str) -> None:
-        """Add a message to a chat."""
+        """Add a message to a chat and bump its updated_at in one round-trip."""
         async with self.pool.acquire() as conn:
-            # Add message
-            await conn.execute(
-                """
-                INSERT INTO messages (chat_id, role, content)
-                VALUES ($1, $2, $3)
-                """,
-                chat_id, role, content
-            )
-            
-            # Update chat's updated_at timestamp
+            # Writable CTE: insert the message and touch the chat in a single
+            # statement, with NOW() computed server-side
+            await conn.execute(SQL_ADD_MESSAGE_CTE, chat_id, role, content)
+    
+    async def add_messages_bulk(self, chat_id: int, rows: List[tuple]) -> None:
+        """Insert many (role, content) messages for a chat in one round-trip.
+
+        Backfill/import paths (summarization rewrites, seeding prompts)
+        should use this instead of looping add_message: COPY resolves the
+        whole batch in a single statement and skips per-row parsing.
+        Falls back to executemany where COPY is not permitted.
+        """
+        if not rows:
+            return
+
+        now = datetime.now()
+        records = [(chat_id, role, content, now) for role, content in rows]
+
+        async with self.pool.acquire() as conn:
+            # A failed COPY aborts its transaction, so the fallback runs
+            # in a fresh one on the same connection
+            try:
+                async with conn.transaction():
+                    await conn.copy_records_to_table(
+                        "messages",
+                        records=records,
+                        columns=["chat_id", "role", "content", "timestamp"],
+                    )
+            except asyncpg.PostgresError:
+                async with conn.transaction():
+                    await conn.executemany(
+                        """
+                        INSERT INTO messages (chat_id, role, content, timestamp)
+                        VALUES ($1, $2, $3, $4)
+                        """,
+                        records,
+                    )
             await conn.execute(
                 """
-                UPDATE chats SET updated_at = $1 WHERE id = $2
+                UPDATE chats
+                SET updated_at = NOW(), message_count = message_count + $2
+                WHERE id = $1
                 """,
-                datetime.now(), chat_id
+                chat_id, len(records),
             )
-    
+
     async def delete_chat(self, chat_id: int) -> bool:
         """Delete a chat."""
         async with self.pool.acquire() as conn:
@@ -20,10 +20,16 @@ CREATE TABLE IF NOT EXISTS chats (
     title TEXT NOT NULL,
     model TEXT NOT NULL,
     system_prompt TEXT,
+    -- Denormalized counter maintained by add_message; avoids counting
+    -- the messages table just to show a chat's size
+    message_count INTEGER NOT NULL DEFAULT 0,
     created_at TIMESTAMP NOT NULL DEFAULT NOW(),
     updated_at TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
+-- Upgrade path for databases created before message_count existed
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0;
+
 -- Messages table
 CREATE TABLE IF NOT EXISTS messages (
     id SERIAL PRIMARY KEY,
@@ -33,6 +39,17 @@ CREATE TABLE IF NOT EXISTS messages (
     timestamp TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
+-- Backfill message_count for chats created before the counter existed.
+-- Guarded on message_count = 0, so after the first run (and for chats
+-- with no messages) this touches nothing on later startups.
+UPDATE chats c
+SET message_count = m.cnt
+FROM (SELECT chat_id, count(*) AS cnt FROM messages GROUP BY chat_id) m
+WHERE m.chat_id = c.id AND c.message_count = 0;
+
 -- Create indexes
 CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_ts ON messages(chat_id, timestamp);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_nonerror ON messages(chat_id, timestamp)
+    WHERE NOT (role = 'assistant' AND content LIKE '⚠️ Ошибка%');
 CREATE INDEX IF NOT EXISTS idx_chats_user_id ON chats(user_id); 
\ No newline at end of file
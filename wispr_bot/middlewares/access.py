@@ -1,16 +1,99 @@
-from typing import Dict, Any, Callable, Awaitable
+import asyncio
+from typing import Dict, Any, Callable, Awaitable, Optional
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
+from cachetools import TTLCache
 
 from ..utils.logger import logger
 from ..database.db import db
 from ..models.user import User
 from ..config import config
 
+# Bound once at import: admin IDs never change at runtime and the frozenset
+# membership test runs on every event
+_admin_ids = config.admin_user_ids
+
+
+class UserLoader:
+    """Coalesce concurrent user lookups into a single batched query.
+
+    Lookups arriving within the batching window are collected and resolved
+    with one SELECT ... WHERE telegram_id = ANY($1) statement, so a burst
+    of N simultaneous events costs one DB round-trip instead of N.
+    """
+
+    def __init__(self, window: float = 0.005):
+        self._window = window
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def load(self, telegram_id: int) -> Optional[User]:
+        """Get a user by Telegram ID, batched with concurrent callers."""
+        future = self._pending.get(telegram_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            # Каждый батч планирует свой собственный flush в момент первой
+            # вставки: проверка "задача ещё жива" теряла лукапы, пришедшие
+            # после того, как _flush уже забрал _pending, но ещё ждал БД —
+            # их фьючи никто больше не разрешал
+            schedule_flush = not self._pending
+            self._pending[telegram_id] = future
+            if schedule_flush:
+                self._flush_task = asyncio.create_task(self._flush())
+        return await future
+
+    async def _flush(self) -> None:
+        """Drain the pending set with one batched query after the window."""
+        await asyncio.sleep(self._window)
+        pending, self._pending = self._pending, {}
+        try:
+            users = await db.get_users_by_ids(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        users_by_id = {user.telegram_id: user for user in users}
+        for telegram_id, future in pending.items():
+            if not future.done():
+                future.set_result(users_by_id.get(telegram_id))
+
+
+user_loader = UserLoader()
+
+# Фоновые touch-задачи держатся в set, чтобы их не собрал GC на лету,
+# а done-callback снимает ссылку и логирует проглоченные исключения
+_touch_tasks: set = set()
+
+
+def _on_touch_done(task: asyncio.Task) -> None:
+    _touch_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.opt(exception=task.exception()).warning(
+            "Failed to refresh last_active"
+        )
+
+
+def _touch_last_active(telegram_id: int) -> None:
+    """Refresh last_active in the background without blocking the event."""
+    task = asyncio.create_task(db.touch_user_last_active(telegram_id))
+    _touch_tasks.add(task)
+    task.add_done_callback(_on_touch_done)
+
 
 class AccessMiddleware(BaseMiddleware):
     """Middleware to check if a user is allowed to use the bot."""
-    
+
+    # Short-lived in-process cache so repeated events from the same user
+    # skip the DB entirely. Invalidated from the Database update methods.
+    user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+    @classmethod
+    def invalidate_user(cls, telegram_id: int) -> None:
+        """Drop a cached user so the next event re-reads it from the DB."""
+        cls.user_cache.pop(telegram_id, None)
+
     async def __call__(
         self,
         handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
@@ -19,12 +102,7 @@ class AccessMiddleware(BaseMiddleware):
     ) -> Any:
         """Check if user is allowed to use the bot."""
         # Get user from update
-        if isinstance(event, Message):
-            user_id = event.from_user.id
-            username = event.from_user.username
-            first_name = event.from_user.first_name
-            last_name = event.from_user.last_name
-        elif isinstance(event, CallbackQuery):
+        if isinstance(event, (Message, CallbackQuery)):
             user_id = event.from_user.id
             username = event.from_user.username
             first_name = event.from_user.first_name
@@ -32,34 +110,65 @@ class AccessMiddleware(BaseMiddleware):
         else:
             # Allow non-user updates to pass through
             return await handler(event, data)
-        
-        # Get user from database
-        user = await db.get_user(user_id)
-        
-        # If user does not exist, create new user
-        if not user:
-            user = User(
-                telegram_id=user_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                is_allowed=user_id in config.admin_user_ids  # Auto-allow admins
-            )
-            await db.create_or_update_user(user)
-        else:
-            # Update user info
-            user.username = username
-            user.first_name = first_name
-            user.last_name = last_name
-            await db.create_or_update_user(user)
-        
+
+        # Admins are allowed by definition, so only the allow decision is
+        # short-circuited. Профиль (свой API-ключ, выбранная модель) живёт
+        # в строке users, поэтому на промахе кеша она всё равно читается
+        # через батчинг-лоадер и создаётся апсертом при первом событии —
+        # иначе /setapikey и /setmodel для админов не имели бы эффекта
+        is_admin = user_id in _admin_ids
+        if is_admin:
+            user = self.user_cache.get(user_id)
+            if user is None:
+                user = await user_loader.load(user_id)
+                if user is None or (
+                    # Profile fields changed — rewrite them with the full
+                    # upsert, same as the non-admin path below
+                    (user.username, user.first_name, user.last_name)
+                    != (username, first_name, last_name)
+                ):
+                    user = await db.upsert_user_returning(
+                        telegram_id=user_id,
+                        username=username,
+                        first_name=first_name,
+                        last_name=last_name,
+                        is_allowed=True,
+                    )
+                self.user_cache[user_id] = user
+            _touch_last_active(user_id)
+            data["user"] = user
+            return await handler(event, data)
+
+        # Look up the user in the cache; on a miss, read via the batching
+        # loader so concurrent events share one DB query, and create the
+        # row with a single upsert only for first-time users
+        user = self.user_cache.get(user_id)
+        if user is None:
+            user = await user_loader.load(user_id)
+            if user is None or (
+                # Profile fields changed — rewrite them with the full upsert
+                (user.username, user.first_name, user.last_name)
+                != (username, first_name, last_name)
+            ):
+                user = await db.upsert_user_returning(
+                    telegram_id=user_id,
+                    username=username,
+                    first_name=first_name,
+                    last_name=last_name,
+                    is_allowed=is_admin  # Auto-allow admins
+                )
+            else:
+                # Steady state: only touch last_active, no full-row write
+                await db.touch_user_last_active(user_id)
+            self.user_cache[user_id] = user
+
         # Add user to data dict for handlers
         data["user"] = user
-        
+
         # Check if user is allowed to use the bot
-        if user.is_allowed or user_id in config.admin_user_ids:
+        if user.is_allowed or is_admin:
             return await handler(event, data)
-        
+
         # If user is not allowed, send message and stop processing
         if isinstance(event, Message):
             await event.answer(
@@ -70,6 +179,6 @@ class AccessMiddleware(BaseMiddleware):
                 "⚠️ У вас нет доступа к этому боту.",
                 show_alert=True
             )
-        
+
         logger.warning(f"Unauthorized access attempt by user {user_id} ({username})")
-        return None 
\ No newline at end of file
+        return None
@@ -1,66 +1,119 @@
 from datetime import datetime
 from typing import List, Optional
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, PrivateAttr
 
 
 class ChatMessage(BaseModel):
     """Model representing a single message in a chat."""
-    
+
     role: str  # 'user', 'assistant', or 'system'
     content: str
-    timestamp: datetime = Field(default_factory=datetime.now)
+    # Stamped by the DB (DEFAULT NOW()); None only before the row exists
+    timestamp: Optional[datetime] = None
 
 
 class Chat(BaseModel):
     """Model representing a conversation thread."""
-    
+
     id: int
     user_id: int
     title: str
     model: str
     messages: List[ChatMessage] = []
-    created_at: datetime = Field(default_factory=datetime.now)
-    updated_at: datetime = Field(default_factory=datetime.now)
+    # Stamped by the DB (DEFAULT NOW()); None only before the row exists
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
     system_prompt: Optional[str] = None
-    
+
+    # Отформатированная база контекста (системный промпт + история),
+    # чтобы длинный чат не пересобирал N словарей на каждый ход.
+    # _context_cache_prompt запоминает промпт на момент сборки: если его
+    # поменяли, кеш считается холодным без сеттера-свойства
+    _context_cache: Optional[List[dict]] = PrivateAttr(default=None)
+    _context_cache_prompt: Optional[str] = PrivateAttr(default=None)
+
     def add_message(self, role: str, content: str) -> None:
         """Add a new message to the chat."""
         self.messages.append(
             ChatMessage(role=role, content=content)
         )
         self.updated_at = datetime.now()
-    
-    def get_context_messages(self, current_user_message: Optional[str] = None, max_tokens: int = 4000) -> List[dict]:
+        # Тёплый кеш контекста дополняется на месте вместо инвалидации,
+        # с тем же фильтром ошибок и той же шириной окна, что и при
+        # полной пересборке
+        if self._context_cache is not None:
+            if not (role == 'assistant' and content.startswith('⚠️ Ошибка')):
+                self._context_cache.append({"role": role, "content": content})
+                head = 1 if self._context_cache_prompt else 0
+                if len(self._context_cache) - head > 20:
+                    del self._context_cache[head]
+
+    def get_context_messages(
+        self,
+        current_user_message: Optional[str] = None,
+        max_tokens: int = 4000,
+        recent_messages: Optional[List["ChatMessage"]] = None,
+    ) -> List[dict]:
         """
         Get messages formatted for OpenAI API with token limit.
         This is a simplified version - in a real app, you'd need to count tokens properly.
+
+        When recent_messages is given (already filtered and capped by the DB,
+        newest first), it is used instead of the in-memory history.
+
+        The in-memory base (system prompt + history) is cached on the
+        instance and kept current by add_message, so repeated calls on a
+        long chat don't rebuild the whole dict list.
         """
-        formatted_messages = []
-        
-        # Add system prompt if it exists
-        if self.system_prompt:
-            formatted_messages.append({"role": "system", "content": self.system_prompt})
-        
-        # Add conversation history, newest last
-        user_messages = []
-        for msg in self.messages[-20:]:  # Simplified token management - just keep last 20 messages
-            # Проверяем, не содержит ли сообщение ошибку
-            if msg.role == 'assistant' and msg.content.startswith('⚠️ Ошибка'):
-                continue  # Пропускаем сообщения с ошибками
-            
-            user_messages.append({"role": msg.role, "content": msg.content})
-        
-        # Если в результате фильтрации у нас не осталось сообщений, добавим базовое приветствие
-        if not user_messages and not formatted_messages:
-            # Если ничего нет, хотя бы добавим системное сообщение для инициализации диалога
-            formatted_messages.append({
-                "role": "system", 
-                "content": "Вы полезный ассистент, который отвечает на вопросы пользователя."
-            })
-        else:
-            formatted_messages.extend(user_messages)
-        
+        base: Optional[List[dict]] = None
+        if (
+            recent_messages is None
+            and self._context_cache is not None
+            and self._context_cache_prompt == self.system_prompt
+        ):
+            base = self._context_cache
+
+        if base is None:
+            formatted_messages = []
+
+            # Add system prompt if it exists
+            if self.system_prompt:
+                formatted_messages.append({"role": "system", "content": self.system_prompt})
+
+            # Add conversation history, newest last, in a single pass
+            if recent_messages is not None:
+                history = reversed(recent_messages)
+            else:
+                history = self.messages[-20:]  # Simplified token management - just keep last 20 messages
+
+            user_messages = [
+                {"role": msg.role, "content": msg.content}
+                for msg in history
+                # Пропускаем сообщения с ошибками
+                if not (msg.role == 'assistant' and msg.content.startswith('⚠️ Ошибка'))
+            ]
+
+            # Если в результате фильтрации у нас не осталось сообщений, добавим базовое приветствие
+            fallback = False
+            if not user_messages and not formatted_messages:
+                # Если ничего нет, хотя бы добавим системное сообщение для инициализации диалога
+                formatted_messages.append({
+                    "role": "system",
+                    "content": "Вы полезный ассистент, который отвечает на вопросы пользователя."
+                })
+                fallback = True
+            else:
+                formatted_messages.extend(user_messages)
+
+            base = formatted_messages
+            # Кешируем только штатную сборку из self.messages: заглушка
+            # для пустого чата и внешние recent_messages не кешируются
+            if recent_messages is None and not fallback:
+                self._context_cache = base
+                self._context_cache_prompt = self.system_prompt
+
+        # Наружу уходит копия, кеш остаётся приватным
+        result = list(base)
         if current_user_message:
-            formatted_messages.append({"role": "user", "content": current_user_message})
-            
-        return formatted_messages 
\ No newline at end of file
+            result.append({"role": "user", "content": current_user_message})
+        return result
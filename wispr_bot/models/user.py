@@ -13,8 +13,12 @@ class User(BaseModel):
     is_allowed: bool = False
     openai_api_key: Optional[str] = None
     preferred_model: Optional[str] = None
-    created_at: datetime = datetime.now()
-    last_active: datetime = datetime.now()
+    # Stamped by the DB (DEFAULT NOW()); None only before the row exists.
+    # A Python-side default here would also be wrong: a class-level
+    # datetime.now() is evaluated once at import and shared by every
+    # instance.
+    created_at: Optional[datetime] = None
+    last_active: Optional[datetime] = None
     
     @property
     def full_name(self) -> str:
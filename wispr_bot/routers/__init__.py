@@ -1,5 +1,5 @@
 """Router modules for Wispr Bot."""
 
-from . import admin, settings, chats, images
+from . import admin, commands, settings, chats, images
 
-__all__ = ["admin", "settings", "chats", "images"] 
\ No newline at end of file
+__all__ = ["admin", "commands", "settings", "chats", "images"] 
\ No newline at end of file
@@ -1,25 +1,144 @@
-from aiogram import Router, F, Bot
-from aiogram.types import Message, CallbackQuery
+from aiogram import Router, Bot
+from aiogram.methods import AnswerCallbackQuery, SendMessage
+from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.utils.keyboard import InlineKeyboardBuilder
-
-from typing import Optional, Dict, Set
+from cachetools import LRUCache
+from collections import deque
+from typing import Optional
 import asyncio
+import time
 
+from ..utils import session_cache
 from ..utils.logger import logger
 from ..database.db import db
 from ..models.user import User
 from ..models.chat import Chat
 from ..config import config
-from ..services.openai_service import OpenAIService
+from ..services.openai_service import get_openai_service
 
 
 # Create router
 router = Router()
 
 
+# Streaming edit coalescing: require both a minimum pause and a minimum
+# amount of new text between editMessageText calls, so one active stream
+# doesn't burn the bot-wide 30 msg/s Telegram budget
+STREAM_EDIT_INTERVAL = 1.2  # seconds
+STREAM_EDIT_MIN_DELTA = 80  # characters
+
+# Global cap on concurrent OpenAI streams: under a burst of users this
+# bounds open HTTPS streams (and the rate-limit pressure on OpenAI)
+# instead of letting every message open its own
+OPENAI_STREAM_SEMAPHORE = asyncio.Semaphore(config.max_concurrent_streams)
+
+# Per-chat ring buffer of recent messages, pre-built in OpenAI format.
+# Turns the per-turn "fetch and rebuild the whole window" into an O(1)
+# append and an O(K) copy; the DB is only hit on a cold cache. Bounded
+# LRU, как и остальные кеши процесса: редкие чаты вытесняются и
+# перечитываются из БД, вместо того чтобы копить по дек-буферу на
+# каждый чат навсегда.
+# Размер совпадает с limit у db.get_chat_context_messages и окном
+# Chat.get_context_messages — тёплый и холодный кеш дают один и тот же
+# промпт (и расход токенов)
+CONTEXT_CACHE_SIZE = 20
+CONTEXT_CACHE_CHATS = 1024
+chat_context_cache: LRUCache = LRUCache(maxsize=CONTEXT_CACHE_CHATS)
+
+
+# Compact callback_data: a one-character kind prefix plus the chat id in
+# hex. The Bot API only accepts UTF-8 strings (raw binary is out), but
+# this still keeps every payload under ~17 bytes vs ~25 for the old
+# "delete_chat:<id>" form and makes dispatch a single-char dict lookup
+_CB_SELECT = "c"
+_CB_DELETE = "d"
+_CB_DELETE_CANCEL = "x"
+_CB_MORE = "m"
+
+# Static buttons and messages are validated/built once at import instead
+# of once per call
+_CANCEL_DELETE_BUTTON = InlineKeyboardButton(
+    text="❌ Отмена", callback_data=_CB_DELETE_CANCEL
+)
+
+_NO_ACTIVE_CHAT_TEXT = (
+    "❓ У вас нет активного чата.\n\n"
+    "Используйте /newchat, чтобы создать новый чат, или /chats, чтобы выбрать существующий."
+)
+_CHAT_NOT_FOUND_TEXT = (
+    "❓ Ваш активный чат не найден.\n\n"
+    "Используйте /newchat, чтобы создать новый чат, или /chats, чтобы выбрать существующий."
+)
+
+
+def _split_long_response(text: str, limit: int = 4000) -> list:
+    """Split a long response into Telegram-sized parts in a single pass.
+
+    Parts break on line boundaries and fenced code blocks are kept
+    intact where possible. Lines are accumulated in a list and joined
+    once per part, instead of growing a string (quadratic for long
+    responses). Parts that still exceed the hard Telegram limit are
+    sliced bluntly.
+    """
+    parts = []
+    current = []
+    current_len = 0
+    code_block_active = False
+
+    for line in text.split('\n'):
+        # Проверяем, не начинается/заканчивается ли строка блоком кода
+        stripped = line.strip()
+        if stripped.startswith("```") or stripped.endswith("```"):
+            code_block_active = not code_block_active
+
+        line_len = len(line) + 1
+        # Если добавление этой строки превысит размер части и мы не внутри блока кода
+        if current_len + line_len > limit and not code_block_active and current:
+            parts.append('\n'.join(current) + '\n')
+            current = [line]
+            current_len = line_len
+        else:
+            current.append(line)
+            current_len += line_len
+
+    if current:
+        parts.append('\n'.join(current) + '\n')
+
+    # Если часть всё равно слишком большая (огромный блок кода), разбиваем грубо
+    sized = []
+    for part in parts:
+        if len(part) > 4096:
+            sized.extend(part[i:i + limit] for i in range(0, len(part), limit))
+        else:
+            sized.append(part)
+    return sized
+
+
+def _chat_button(chat) -> InlineKeyboardButton:
+    """Build a select-chat button from a chats row."""
+    return InlineKeyboardButton(
+        text=f"{chat['title']} ({chat['model']})",
+        callback_data=f"{_CB_SELECT}{chat['id']:x}",
+    )
+
+
+def _delete_chat_button(chat) -> InlineKeyboardButton:
+    """Build a delete-chat button from a chats row."""
+    return InlineKeyboardButton(
+        text=f"🗑 {chat['title']}",
+        callback_data=f"{_CB_DELETE}{chat['id']:x}",
+    )
+
+
+def _more_chats_button(offset: int) -> InlineKeyboardButton:
+    """Build the next-page button carrying the offset in hex."""
+    return InlineKeyboardButton(
+        text="Показать больше...", callback_data=f"{_CB_MORE}{offset:x}"
+    )
+
+
 # Chat states
 class ChatStates(StatesGroup):
     """States for chat operations."""
@@ -27,37 +146,37 @@ class ChatStates(StatesGroup):
     in_chat = State()  # When user is actively in a chat
 
 
-# Session storage for active chats
-# This is a simple in-memory storage, which will be reset on bot restart
-active_chats: Dict[int, int] = {}  # user_id -> chat_id
-
-# Set для отслеживания пользователей, которые ожидают ответа от OpenAI
-# Используется для предотвращения обработки новых сообщений до завершения предыдущего запроса
-processing_users: Set[int] = set()
-
-
 @router.message(Command("newchat"))
-async def new_chat_command(message: Message, state: FSMContext, user: User) -> None:
+async def new_chat_command(message: Message, state: FSMContext, user: User) -> SendMessage:
     """Start creating a new chat."""
-    await message.answer(
-        "🆕 Создание нового чата\n\n"
-        "Пожалуйста, введите название для вашего нового чата:",
-        parse_mode="Markdown"
-    )
-    
     # Set state to waiting for title
     await state.set_state(ChatStates.waiting_for_title)
 
+    # Returned methods ride the webhook response (or get executed by the
+    # polling dispatcher), saving one Bot API round-trip per command
+    return SendMessage(
+        chat_id=message.chat.id,
+        text=(
+            "🆕 Создание нового чата\n\n"
+            "Пожалуйста, введите название для вашего нового чата:"
+        ),
+        parse_mode="Markdown",
+    )
+
 
 @router.message(StateFilter(ChatStates.waiting_for_title), Command("cancel"))
-async def cancel_new_chat(message: Message, state: FSMContext) -> None:
+async def cancel_new_chat(message: Message, state: FSMContext) -> SendMessage:
     """Cancel new chat creation."""
     await state.clear()
-    await message.answer("❌ Создание нового чата отменено", parse_mode="Markdown")
+    return SendMessage(
+        chat_id=message.chat.id,
+        text="❌ Создание нового чата отменено",
+        parse_mode="Markdown",
+    )
 
 
 @router.message(StateFilter(ChatStates.waiting_for_title))
-async def process_new_chat_title(message: Message, state: FSMContext, user: User) -> None:
+async def process_new_chat_title(message: Message, state: FSMContext, user: User) -> SendMessage:
     """Process the title for a new chat."""
     # Get title from message
     title = message.text.strip()
@@ -72,66 +191,58 @@ async def process_new_chat_title(message: Message, state: FSMContext, user: User
         model=model
     )
     
-    # Set active chat for user
-    active_chats[user.telegram_id] = chat.id
-    
-    # Set state to in chat
+    # Set state to in chat; FSM state is the single source of truth for
+    # the active chat
     await state.set_state(ChatStates.in_chat)
     await state.update_data(chat_id=chat.id)
-    
-    await message.answer(
-        f"✅ Создан новый чат: \"*{title}*\"\n\n"
-        f"Теперь вы общаетесь с моделью `{model}`.\n"
-        f"Отправьте любое сообщение, чтобы начать разговор.",
-        parse_mode="Markdown"
-    )
+
     logger.info(f"User {user.telegram_id} created new chat {chat.id}: {title}")
+    return SendMessage(
+        chat_id=message.chat.id,
+        text=(
+            f"✅ Создан новый чат: \"*{title}*\"\n\n"
+            f"Теперь вы общаетесь с моделью `{model}`.\n"
+            f"Отправьте любое сообщение, чтобы начать разговор."
+        ),
+        parse_mode="Markdown",
+    )
 
 
 @router.message(Command("chats"))
 async def list_chats(message: Message, user: User) -> None:
     """List user's chats."""
-    # Get user's chats
-    chats = await db.get_user_chats(user.telegram_id)
-    
+    # Get user's 10 most recent chats in one summary query (no message
+    # hydration); the window count covers the header and the "more" button
+    chats = await db.get_user_chats_summary(user.telegram_id, limit=10)
+
     if not chats:
         await message.answer(
             "📝 У вас еще нет чатов.\n\n"
             "Используйте /newchat, чтобы создать первый чат."
         )
         return
-    
-    # Build keyboard with chats
-    builder = InlineKeyboardBuilder()
-    
-    for chat in chats[:10]:  # Limit to first 10 chats to avoid huge keyboards
-        builder.button(
-            text=f"{chat['title']} ({chat['model']})",
-            callback_data=f"chat:{chat['id']}"
-        )
-    
+
+    total = chats[0]['total']
+
+    # Build keyboard with chats, one button per row
+    rows = [[_chat_button(chat)] for chat in chats]
+
     # Add a button for more chats if needed
-    if len(chats) > 10:
-        builder.button(
-            text="Показать больше...",
-            callback_data="chats:more"
-        )
-    
-    builder.adjust(1)  # One button per row
-    
+    if total > len(chats):
+        rows.append([_more_chats_button(len(chats))])
+
     await message.answer(
-        f"📝 Ваши чаты ({len(chats)}):\n\n"
+        f"📝 Ваши чаты ({total}):\n\n"
         f"Нажмите на чат, чтобы продолжить разговор:",
-        reply_markup=builder.as_markup()
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
     )
 
 
-@router.callback_query(F.data.startswith("chat:"))
-async def select_chat(callback: CallbackQuery, state: FSMContext, user: User) -> None:
+async def select_chat(callback: CallbackQuery, state: FSMContext, user: User) -> Optional[SendMessage]:
     """Select a chat to continue."""
-    # Get chat id from callback data
-    chat_id = int(callback.data.split(":", 1)[1])
-    
+    # Get chat id from callback data (hex after the kind prefix)
+    chat_id = int(callback.data[1:], 16)
+
     # Get chat from database
     chat = await db.get_chat(chat_id)
     
@@ -139,124 +250,158 @@ async def select_chat(callback: CallbackQuery, state: FSMContext, user: User) ->
         await callback.answer("❌ Чат не найден или отказано в доступе", show_alert=True)
         return
     
-    # Set active chat for user
-    active_chats[user.telegram_id] = chat.id
-    
     # Set state to in chat
     await state.set_state(ChatStates.in_chat)
     await state.update_data(chat_id=chat.id)
-    
+
     await callback.answer()
-    await callback.message.answer(
-        f"✅ Переключено на чат: \"*{chat.title}*\"\n\n"
-        f"Теперь вы общаетесь с моделью `{chat.model}`.\n"
-        f"Отправьте любое сообщение, чтобы продолжить разговор.",
-        parse_mode="Markdown"
-    )
     logger.info(f"User {user.telegram_id} switched to chat {chat.id}")
+    return SendMessage(
+        chat_id=callback.message.chat.id,
+        text=(
+            f"✅ Переключено на чат: \"*{chat.title}*\"\n\n"
+            f"Теперь вы общаетесь с моделью `{chat.model}`.\n"
+            f"Отправьте любое сообщение, чтобы продолжить разговор."
+        ),
+        parse_mode="Markdown",
+    )
 
 
 @router.message(Command("deletechat"))
 async def delete_chat_command(message: Message, user: User) -> None:
     """Start the process to delete a chat."""
     # Get user's chats
-    chats = await db.get_user_chats(user.telegram_id)
-    
+    chats = await db.get_user_chats_summary(user.telegram_id, limit=10)
+
     if not chats:
         await message.answer("📝 У вас нет чатов для удаления.")
         return
-    
-    # Build keyboard with chats to delete
-    builder = InlineKeyboardBuilder()
-    
-    for chat in chats[:10]:  # Limit to first 10 chats
-        builder.button(
-            text=f"🗑 {chat['title']}",
-            callback_data=f"delete_chat:{chat['id']}"
-        )
-    
-    builder.button(
-        text="❌ Отмена",
-        callback_data="delete_chat:cancel"
-    )
-    
-    builder.adjust(1)  # One button per row
-    
+
+    # Build keyboard with chats to delete, one button per row
+    rows = [[_delete_chat_button(chat)] for chat in chats]
+    rows.append([_CANCEL_DELETE_BUTTON])
+
     await message.answer(
         "🗑 Выберите чат для удаления:\n\n"
         "⚠️ Это действие нельзя отменить!",
-        reply_markup=builder.as_markup()
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
     )
 
 
-@router.callback_query(F.data.startswith("delete_chat:"))
-async def delete_chat_callback(callback: CallbackQuery, user: User, state: FSMContext) -> None:
+async def delete_chat_callback(callback: CallbackQuery, state: FSMContext, user: User) -> AnswerCallbackQuery:
     """Handle chat deletion."""
-    # Get chat id from callback data
-    chat_id_str = callback.data.split(":", 1)[1]
-    
-    if chat_id_str == "cancel":
-        await callback.answer("Операция отменена")
+    if callback.data == _CB_DELETE_CANCEL:
         await callback.message.edit_text("❌ Удаление чата отменено")
-        return
-    
-    chat_id = int(chat_id_str)
-    
-    # Delete chat
-    success = await db.delete_chat(chat_id)
-    
+        return AnswerCallbackQuery(callback_query_id=callback.id, text="Операция отменена")
+
+    # Get chat id from callback data (hex after the kind prefix)
+    chat_id = int(callback.data[1:], 16)
+
+    # Acknowledge the callback right away (in webhook mode this rides the
+    # webhook response); the actual deletion runs off the hot path
+    asyncio.create_task(_do_delete_chat(chat_id, user, state, callback.message))
+    return AnswerCallbackQuery(callback_query_id=callback.id, text="Удаляю…")
+
+
+async def _do_delete_chat(chat_id: int, user: User, state: FSMContext, message: Message) -> None:
+    """Delete a chat in the background and report the result."""
+    try:
+        success = await db.delete_chat(chat_id)
+    except Exception as e:
+        logger.error(f"Error deleting chat {chat_id}: {e}")
+        success = False
+
     if success:
-        # If deleted chat was active, clear the active chat
-        if active_chats.get(user.telegram_id) == chat_id:
-            active_chats.pop(user.telegram_id, None)
-            # Also clear state if we're in this chat
-            current_data = await state.get_data()
-            if current_data.get('chat_id') == chat_id:
-                await state.clear()
-        
-        await callback.answer("Чат успешно удален")
-        await callback.message.edit_text("✅ Чат успешно удален")
+        # Drop the cached context along with the chat
+        chat_context_cache.pop(chat_id, None)
+
+        # If deleted chat was active, clear the state
+        current_data = await state.get_data()
+        if current_data.get('chat_id') == chat_id:
+            await state.clear()
+
+        await message.edit_text("✅ Чат успешно удален")
         logger.info(f"User {user.telegram_id} deleted chat {chat_id}")
     else:
-        await callback.answer("Не удалось удалить чат", show_alert=True)
-        await callback.message.edit_text("❌ Не удалось удалить чат")
+        await message.edit_text("❌ Не удалось удалить чат")
+
+
+# Callback prefixes map straight to their handlers: one dict lookup per
+# callback instead of evaluating a MagicFilter chain per registered filter.
+# With one-character kinds this IS the first level of a 256-way prefix
+# trie — dispatch stays O(1) no matter how many callback kinds are added
+# (new kinds just add an entry here), so a full aho-corasick automaton
+# would buy nothing for exact single-char prefixes
+async def more_chats(callback: CallbackQuery, state: FSMContext, user: User) -> AnswerCallbackQuery:
+    """Extend the chat list keyboard with the next page of chats."""
+    # Page offset rides in the callback data (hex after the kind prefix);
+    # a bare "m" from a pre-paging keyboard reads as offset 0
+    offset = int(callback.data[1:] or "0", 16)
+    chats = await db.get_user_chats_summary(user.telegram_id, limit=10, offset=offset)
+
+    if not chats:
+        return AnswerCallbackQuery(callback_query_id=callback.id, text="Больше чатов нет")
+
+    total = chats[0]['total']
+
+    # Replace the "more" row with the new page (and a fresh "more" button
+    # if there are chats beyond it)
+    rows = list(callback.message.reply_markup.inline_keyboard[:-1])
+    rows.extend([_chat_button(chat)] for chat in chats)
+    shown = offset + len(chats)
+    if total > shown:
+        rows.append([_more_chats_button(shown)])
+
+    await callback.message.edit_reply_markup(
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows)
+    )
+    return AnswerCallbackQuery(callback_query_id=callback.id)
+
+
+_CB_HANDLERS = {
+    _CB_SELECT: select_chat,
+    _CB_DELETE: delete_chat_callback,
+    _CB_DELETE_CANCEL: delete_chat_callback,
+    _CB_MORE: more_chats,
+}
+
+
+@router.callback_query()
+async def dispatch_callback(callback: CallbackQuery, state: FSMContext, user: User):
+    """Dispatch callback queries for this router by their kind prefix."""
+    handler = _CB_HANDLERS.get(callback.data[:1])
+    if handler is None:
+        return None
+    return await handler(callback, state, user)
 
 
 @router.message(Command("currentchat"))
 async def current_chat_info(message: Message, user: User, state: FSMContext) -> None:
     """Show information about the current active chat."""
-    # Check if user has an active chat
-    chat_id = active_chats.get(user.telegram_id)
-    
+    # Check if user has an active chat (FSM state is the source of truth)
+    data = await state.get_data()
+    chat_id = data.get('chat_id')
+
     if not chat_id:
-        await message.answer(
-            "❓ У вас нет активного чата.\n\n"
-            "Используйте /newchat, чтобы создать новый чат, или /chats, чтобы выбрать существующий.",
-            parse_mode="Markdown"
-        )
+        await message.answer(_NO_ACTIVE_CHAT_TEXT, parse_mode="Markdown")
         return
-    
-    # Get chat from database
-    chat = await db.get_chat(chat_id)
-    
+
+    # Get chat metadata only — the message count comes from the summary
+    # query instead of hydrating the full message list
+    chat = await db.get_chat_summary(chat_id)
+
     if not chat:
         # Chat not found - maybe it was deleted
-        active_chats.pop(user.telegram_id, None)
         await state.clear()
-        await message.answer(
-            "❓ Ваш активный чат не найден.\n\n"
-            "Используйте /newchat, чтобы создать новый чат, или /chats, чтобы выбрать существующий.",
-            parse_mode="Markdown"
-        )
+        await message.answer(_CHAT_NOT_FOUND_TEXT, parse_mode="Markdown")
         return
-    
+
     # Show chat info
-    msg_count = len(chat.messages)
     await message.answer(
-        f"📝 Текущий чат: \"*{chat.title}*\"\n\n"
-        f"• Модель: `{chat.model}`\n"
-        f"• Создан: {chat.created_at.strftime('%Y-%m-%d')}\n"
-        f"• Сообщений: {msg_count}\n\n"
+        f"📝 Текущий чат: \"*{chat['title']}*\"\n\n"
+        f"• Модель: `{chat['model']}`\n"
+        f"• Создан: {chat['created_at'].strftime('%Y-%m-%d')}\n"
+        f"• Сообщений: {chat['msg_count']}\n\n"
         f"Используйте /chats, чтобы переключиться на другой чат.",
         parse_mode="Markdown"
     )
@@ -269,48 +414,42 @@ async def process_chat_message(message: Message, state: FSMContext, user: User)
     if message.text.startswith('/'):
         return
     
-    # Проверяем, не обрабатывается ли уже запрос от этого пользователя
-    if user.telegram_id in processing_users:
+    # Атомарно помечаем пользователя как обрабатываемого: проверка и
+    # установка происходят одним шагом, так что параллельные события не
+    # могут запустить два запроса к OpenAI
+    if not await session_cache.mark_processing(user.telegram_id):
         await message.answer(
             "⏳ Ваш предыдущий запрос еще обрабатывается. Пожалуйста, подождите."
         )
         return
-    
-    # Добавляем пользователя в множество обрабатываемых
-    processing_users.add(user.telegram_id)
-    
+
+    user_insert_task: Optional[asyncio.Task] = None
     try:
         # Get chat id from state
         data = await state.get_data()
         chat_id = data.get('chat_id')
         
-        # If no chat id in state, try to get from active chats
+        # If no chat id in state, create a new chat
         if not chat_id:
-            chat_id = active_chats.get(user.telegram_id)
-            
-            # If still no chat id, create a new chat
-            if not chat_id:
-                await message.answer(
-                    "❓ У вас нет активного чата.\n\n"
-                    "Я создам новый для вас.",
-                )
-                # Create new chat with default title
-                chat = await db.create_chat(
-                    user_id=user.telegram_id,
-                    title=f"Чат {message.date.strftime('%Y-%m-%d %H:%M')}",
-                    model=user.preferred_model or config.default_model
-                )
-                chat_id = chat.id
-                # Set active chat and update state
-                active_chats[user.telegram_id] = chat_id
-                await state.update_data(chat_id=chat_id)
+            await message.answer(
+                "❓ У вас нет активного чата.\n\n"
+                "Я создам новый для вас.",
+            )
+            # Create new chat with default title
+            chat = await db.create_chat(
+                user_id=user.telegram_id,
+                title=f"Чат {message.date.strftime('%Y-%m-%d %H:%M')}",
+                model=user.preferred_model or config.default_model
+            )
+            chat_id = chat.id
+            # Remember it in state
+            await state.update_data(chat_id=chat_id)
         
         # Get chat from database
         chat = await db.get_chat(chat_id)
         
         if not chat:
             # Chat not found - maybe it was deleted
-            active_chats.pop(user.telegram_id, None)
             await state.clear()
             await message.answer(
                 "❓ Ваш активный чат не найден.\n\n"
@@ -323,153 +462,161 @@ async def process_chat_message(message: Message, state: FSMContext, user: User)
                 model=user.preferred_model or config.default_model
             )
             chat_id = chat.id
-            # Set active chat and update state
-            active_chats[user.telegram_id] = chat_id
+            # Remember it in state
             await state.set_state(ChatStates.in_chat)
             await state.update_data(chat_id=chat_id)
         
         # Сохраняем текущее сообщение пользователя, чтобы знать, на какой запрос отвечаем
         current_user_message = message.text
-        
-        # Add user message to chat
-        await db.add_message(chat_id, "user", current_user_message)
-        
-        # Отправляем временное сообщение "Генерация ответа..." и сохраняем его ID для обновления
-        temp_message = await message.answer("⏳ *Генерация ответа*...", parse_mode="Markdown")
-        
-        # Send "typing" action
+
+        # Warm the per-chat context buffer; the DB (which error-filters
+        # and caps server-side) is only consulted on a cold cache
+        context_deque = chat_context_cache.get(chat_id)
+        if context_deque is None:
+            recent_messages = await db.get_chat_context_messages(chat_id)
+            context_deque = deque(
+                (
+                    {"role": msg.role, "content": msg.content}
+                    for msg in reversed(recent_messages)
+                ),
+                maxlen=CONTEXT_CACHE_SIZE,
+            )
+            chat_context_cache[chat_id] = context_deque
+
+        # Persist the user message in the background: the insert overlaps
+        # with the OpenAI stream instead of delaying it by one DB RTT
+        user_insert_task = asyncio.create_task(
+            db.add_message(chat_id, "user", current_user_message)
+        )
+
+        # Send "typing" action once; the placeholder message is deferred
+        # until the first OpenAI chunk arrives, so short replies cost a
+        # single sendMessage instead of send + edits
         await message.bot.send_chat_action(message.chat.id, "typing")
         
-        # Process with OpenAI
-        openai_service = OpenAIService(user.openai_api_key if user.has_custom_api_key else None)
-        
-        # Get messages context from chat
-        context_messages = chat.get_context_messages(current_user_message)
+        # Process with OpenAI (cached per user, reuses the warm client)
+        openai_service = get_openai_service(user)
         
+        # Собираем контекст из кольцевого буфера (дешёвая C-копия)
+        context_messages = []
+        if chat.system_prompt:
+            context_messages.append({"role": "system", "content": chat.system_prompt})
+        context_messages.extend(context_deque)
+        context_messages.append({"role": "user", "content": current_user_message})
+
+        # Буфер сразу получает сообщение пользователя; ответ ассистента
+        # добавится после завершения генерации
+        context_deque.append({"role": "user", "content": current_user_message})
+
+
         # Проверяем, что у нас есть сообщения в контексте
         if not context_messages:
-            await message.bot.edit_message_text(
+            await message.answer(
                 "⚠️ *Ошибка*: Не удалось сформировать контекст сообщений для запроса.",
-                chat_id=message.chat.id,
-                message_id=temp_message.message_id,
                 parse_mode="Markdown"
             )
             return
         
+        # Плейсхолдер появляется только с первым чанком OpenAI (или при
+        # очереди); короткие ответы обходятся без него вовсе
+        temp_message: Optional[Message] = None
+
         # Call OpenAI API
         try:
-            # Запускаем периодический запрос "typing"
-            typing_task = asyncio.create_task(
-                keep_typing(message.bot, message.chat.id)
-            )
-            
-            # Используем потоковую генерацию ответа вместо обычной
+            # Используем потоковую генерацию ответа вместо обычной.
+            # Промежуточные правки сообщения отправляются через дебаунсер:
+            # не чаще STREAM_EDIT_INTERVAL и только при заметном приросте
+            # текста, очередная правка отменяет ещё не отправленную
             final_response = ""
-            update_counter = 0
-            update_interval = 100  # Обновляем сообщение каждые 5 токенов, чтобы не перегружать API Telegram
-            
-            async for response_chunk in openai_service.generate_response_stream(
-                messages=context_messages,
-                model=chat.model
-            ):
-                # Если ответ начинается с ошибки, прерываем обработку
-                if response_chunk.startswith("⚠️ Ошибка"):
-                    final_response = response_chunk
-                    break
-                
-                # Обновляем сообщение с частичным ответом только через некоторые интервалы
-                # чтобы не делать слишком много запросов к API Telegram
-                update_counter += 1
-                if update_counter % update_interval == 0:
-                    try:
-                        # В некоторых случаях ответ может быть очень длинным и не поместиться в одно сообщение
-                        if len(response_chunk) <= 4096:  # Telegram ограничение на длину сообщения
-                            await message.bot.edit_message_text(
-                                response_chunk + " ⏳",  # Добавляем индикатор, что генерация продолжается
-                                chat_id=message.chat.id,
-                                message_id=temp_message.message_id,
-                                parse_mode="Markdown"  # Добавляем поддержку Markdown
-                            )
-                    except Exception as e:
-                        logger.warning(f"Error updating partial response with markdown: {e}")
-                        # Если ошибка связана с разметкой Markdown, пробуем отправить без разметки
-                        try:
-                            # Пробуем очистить или исправить проблемные символы Markdown
-                            clean_response = response_chunk.replace("```", "")  # Убираем блоки кода
-                            clean_response = clean_response.replace("`", "'")   # Заменяем инлайн-код на кавычки
-                            
-                            await message.bot.edit_message_text(
-                                clean_response + " ⏳",
-                                chat_id=message.chat.id,
-                                message_id=temp_message.message_id,
-                                parse_mode="Markdown"
+            # Стартуем "окно дебаунса" сразу: если весь ответ уложится в
+            # одно окно, ни одного промежуточного сообщения не уйдёт
+            last_edit_ts = time.monotonic()
+            last_sent_len = 0
+            edit_task: Optional[asyncio.Task] = None
+
+            # Если все слоты стрима заняты, сообщаем об очереди — лучше
+            # честное "ожидайте", чем замерший индикатор; это сообщение
+            # становится плейсхолдером для стриминговых правок
+            if OPENAI_STREAM_SEMAPHORE.locked():
+                temp_message = await message.answer("⏳ Очередь запросов, ожидайте...")
+
+            async with OPENAI_STREAM_SEMAPHORE:
+                # Генератор отдаёт только дельты; накопленный буфер живёт
+                # здесь, у единственного потребителя
+                async for delta in openai_service.generate_response_stream(
+                    messages=context_messages,
+                    model=chat.model
+                ):
+                    # Если пришла ошибка, прерываем обработку
+                    if delta.startswith("⚠️ Ошибка"):
+                        final_response = delta
+                        break
+
+                    final_response += delta
+
+                    now = time.monotonic()
+                    if (
+                        now - last_edit_ts > STREAM_EDIT_INTERVAL
+                        and len(final_response) - last_sent_len >= STREAM_EDIT_MIN_DELTA
+                        and len(final_response) <= 4096  # Telegram ограничение на длину сообщения
+                    ):
+                        if temp_message is None:
+                            # Первый видимый фрагмент: отправляем его как
+                            # плейсхолдер вместо пустого "Генерация..."
+                            temp_message = await message.answer(
+                                final_response + " ⏳"
                             )
-                        except Exception as e2:
-                            logger.warning(f"Error updating with cleaned markdown: {e2}")
-                            # Если и это не сработало, отправляем без форматирования
-                            try:
-                                await message.bot.edit_message_text(
-                                    response_chunk + " ⏳",
-                                    chat_id=message.chat.id,
-                                    message_id=temp_message.message_id
+                        else:
+                            # Отменяем ещё не завершённую правку — новее данные важнее
+                            if edit_task and not edit_task.done():
+                                edit_task.cancel()
+                            edit_task = asyncio.create_task(
+                                _edit_stream_message(
+                                    message.bot,
+                                    message.chat.id,
+                                    temp_message.message_id,
+                                    final_response,
                                 )
-                            except Exception as e3:
-                                logger.error(f"Failed to update message: {e3}")
-                                # Просто продолжаем, не обновляя сообщение
-                
-                # Сохраняем последний чанк как финальный ответ
-                final_response = response_chunk
-            
-            # Останавливаем периодический запрос "typing"
-            typing_task.cancel()
+                            )
+                        last_edit_ts = now
+                        last_sent_len = len(final_response)
+
+            # Останавливаем висящую правку, чтобы она не перезаписала
+            # финальный ответ
+            if edit_task and not edit_task.done():
+                edit_task.cancel()
             
             # Проверка финального ответа
             if not final_response:
                 final_response = "⚠️ Пустой ответ от API"
                 
-            # Сохраняем финальный ответ в базу
-            await db.add_message(chat_id, "assistant", final_response)
-            
+            # Ответы-ошибки не попадают в контекст (как и в DB-фильтре)
+            if not final_response.startswith("⚠️"):
+                context_deque.append(
+                    {"role": "assistant", "content": final_response}
+                )
+
+            # Сохраняем финальный ответ в базу параллельно с финальной
+            # правкой сообщения — запись скрыта за сетевым вызовом
+            assistant_insert_task = asyncio.create_task(
+                db.add_message(chat_id, "assistant", final_response)
+            )
+
+
             # Обновляем сообщение с финальным ответом (больше без индикатора загрузки)
             try:
                 # Если ответ слишком длинный, разбиваем его на части
                 if len(final_response) > 4096:
-                    # Сначала удаляем временное сообщение
-                    await message.bot.delete_message(
-                        chat_id=message.chat.id,
-                        message_id=temp_message.message_id
-                    )
-                    
+                    # Сначала удаляем временное сообщение, если оно было
+                    if temp_message is not None:
+                        await message.bot.delete_message(
+                            chat_id=message.chat.id,
+                            message_id=temp_message.message_id
+                        )
+
                     # Отправляем ответ частями, сохраняя правильное форматирование Markdown
-                    parts = []
-                    # Разбиваем на части примерно по 4000 символов, но стараемся не разрывать блоки кода
-                    current_part = ""
-                    code_block_active = False
-                    
-                    for line in final_response.split('\n'):
-                        # Проверяем, не начинается/заканчивается ли строка блоком кода
-                        if line.strip().startswith("```") or line.strip().endswith("```"):
-                            code_block_active = not code_block_active
-                            
-                        # Если добавление этой строки превысит размер части и мы не внутри блока кода
-                        if len(current_part + line + '\n') > 4000 and not code_block_active:
-                            parts.append(current_part)
-                            current_part = line + '\n'
-                        else:
-                            current_part += line + '\n'
-                    
-                    # Добавляем последнюю часть
-                    if current_part:
-                        parts.append(current_part)
-                    
-                    # Если после разбиения получилась всего одна часть, проверяем её размер
-                    if len(parts) == 1 and len(parts[0]) > 4096:
-                        # Если часть всё равно слишком большая, разбиваем грубо
-                        rough_parts = []
-                        for i in range(0, len(final_response), 4000):
-                            rough_parts.append(final_response[i:i+4000])
-                        parts = rough_parts
-                    
+                    parts = _split_long_response(final_response)
+
                     # Отправляем каждую часть
                     for i, part in enumerate(parts):
                         try:
@@ -485,6 +632,20 @@ async def process_chat_message(message: Message, state: FSMContext, user: User)
                             except Exception as e2:
                                 # Если и это не помогло, отправляем без форматирования
                                 await message.answer(part)
+                elif temp_message is None:
+                    # Короткий ответ, уложившийся в окно дебаунса:
+                    # единственный исходящий вызов за весь ход
+                    try:
+                        await message.answer(final_response, parse_mode="Markdown")
+                    except Exception as e:
+                        logger.warning(f"Error sending final response with markdown: {e}")
+                        try:
+                            clean_response = final_response.replace("```", "")
+                            clean_response = clean_response.replace("`", "'")
+                            await message.answer(clean_response, parse_mode="Markdown")
+                        except Exception as e2:
+                            logger.warning(f"Error sending with cleaned markdown: {e2}")
+                            await message.answer(final_response)
                 else:
                     try:
                         await message.bot.edit_message_text(
@@ -516,70 +677,118 @@ async def process_chat_message(message: Message, state: FSMContext, user: User)
             except Exception as e:
                 logger.error(f"Error sending final response: {e}")
                 await message.answer(f"⚠️ Ошибка при отправке ответа: {e}", parse_mode="Markdown")
-                
+
+            # Дожидаемся фоновой записи ответа перед выходом
+            await assistant_insert_task
+
         except Exception as e:
             error_message = f"⚠️ *Ошибка* при генерации ответа: {str(e)}"
             logger.error(f"Error generating response: {e}")
-            
-            # Обновляем временное сообщение с ошибкой
+
+            # Обновляем временное сообщение с ошибкой (или отправляем
+            # новое, если плейсхолдер так и не появился)
             try:
-                await message.bot.edit_message_text(
-                    error_message,
-                    chat_id=message.chat.id,
-                    message_id=temp_message.message_id,
-                    parse_mode="Markdown"
-                )
+                if temp_message is None:
+                    await message.answer(error_message, parse_mode="Markdown")
+                else:
+                    await message.bot.edit_message_text(
+                        error_message,
+                        chat_id=message.chat.id,
+                        message_id=temp_message.message_id,
+                        parse_mode="Markdown"
+                    )
             except Exception as e_markdown:
                 # Если возникла ошибка из-за Markdown форматирования, отправляем без него
                 error_message_plain = f"⚠️ Ошибка при генерации ответа: {str(e)}"
-                await message.bot.edit_message_text(
-                    error_message_plain,
-                    chat_id=message.chat.id,
-                    message_id=temp_message.message_id
-                )
+                if temp_message is None:
+                    await message.answer(error_message_plain)
+                else:
+                    await message.bot.edit_message_text(
+                        error_message_plain,
+                        chat_id=message.chat.id,
+                        message_id=temp_message.message_id
+                    )
             
             await db.add_message(chat_id, "assistant", error_message)
     
     finally:
-        # Удаляем пользователя из множества обрабатываемых в любом случае
-        processing_users.discard(user.telegram_id)
+        # Дожидаемся фоновой записи сообщения пользователя, чтобы ошибка
+        # вставки не потерялась вместе с задачей
+        if user_insert_task is not None:
+            try:
+                await user_insert_task
+            except Exception as e:
+                logger.error(f"Error saving user message: {e}")
+        # Снимаем пометку обработки в любом случае
+        await session_cache.clear_processing(user.telegram_id)
+
 
+async def _edit_stream_message(bot: Bot, chat_id: int, message_id: int, text: str) -> None:
+    """Edit the placeholder with a partial response, degrading Markdown.
 
-async def keep_typing(bot: Bot, chat_id: int, interval: float = 4.0):
-    """Keep sending typing action to keep the user informed about ongoing processing."""
+    Runs as a cancellable background task so a newer chunk can drop an
+    edit that has not gone out yet.
+    """
     try:
-        while True:
-            await bot.send_chat_action(chat_id, "typing")
-            await asyncio.sleep(interval)
+        await bot.edit_message_text(
+            text + " ⏳",  # Индикатор, что генерация продолжается
+            chat_id=chat_id,
+            message_id=message_id,
+            parse_mode="Markdown"
+        )
     except asyncio.CancelledError:
-        # Нормальное завершение задачи
-        pass
+        raise
     except Exception as e:
-        logger.error(f"Error in keep_typing: {e}")
+        logger.warning(f"Error updating partial response with markdown: {e}")
+        # Если ошибка связана с разметкой Markdown, пробуем отправить без разметки
+        try:
+            # Пробуем очистить или исправить проблемные символы Markdown
+            clean_response = text.replace("```", "")  # Убираем блоки кода
+            clean_response = clean_response.replace("`", "'")   # Заменяем инлайн-код на кавычки
+
+            await bot.edit_message_text(
+                clean_response + " ⏳",
+                chat_id=chat_id,
+                message_id=message_id,
+                parse_mode="Markdown"
+            )
+        except Exception as e2:
+            logger.warning(f"Error updating with cleaned markdown: {e2}")
+            # Если и это не сработало, отправляем без форматирования
+            try:
+                await bot.edit_message_text(
+                    text + " ⏳",
+                    chat_id=chat_id,
+                    message_id=message_id
+                )
+            except Exception as e3:
+                logger.error(f"Failed to update message: {e3}")
+                # Просто продолжаем, не обновляя сообщение
 
 
 @router.message(Command("exit"))
-async def exit_chat(message: Message, state: FSMContext, user: User) -> None:
+async def exit_chat(message: Message, state: FSMContext, user: User) -> SendMessage:
     """Exit current chat."""
-    # Clear active chat
-    active_chats.pop(user.telegram_id, None)
-    
-    # Clear state
+    # Clear state (the active chat lives only in FSM state)
     await state.clear()
-    
-    await message.answer(
-        "✅ Вы вышли из текущего чата.\n\n"
-        "Используйте /chats, чтобы выбрать чат, или /newchat, чтобы создать новый.",
-        parse_mode="Markdown"
+
+    return SendMessage(
+        chat_id=message.chat.id,
+        text=(
+            "✅ Вы вышли из текущего чата.\n\n"
+            "Используйте /chats, чтобы выбрать чат, или /newchat, чтобы создать новый."
+        ),
+        parse_mode="Markdown",
     )
     
     
 @router.message(Command("clear_history"))
 async def clear_chat_history(message: Message, state: FSMContext, user: User) -> None:
     """Clear history of the current chat."""
-    # Get chat id from active chats
-    chat_id = active_chats.get(user.telegram_id)
-    
+    # Get chat id from state
+    data = await state.get_data()
+    chat_id = data.get('chat_id')
+
     if not chat_id:
         await message.answer(
             "❓ У вас нет активного чата для очистки истории.\n\n"
@@ -592,15 +801,10 @@ async def clear_chat_history(message: Message, state: FSMContext, user: User) ->
     chat = await db.get_chat(chat_id)
     
     if not chat:
-        await message.answer(
-            "❓ Ваш активный чат не найден.\n\n"
-            "Используйте /newchat, чтобы создать новый чат, или /chats, чтобы выбрать существующий.",
-            parse_mode="Markdown"
-        )
-        active_chats.pop(user.telegram_id, None)
+        await message.answer(_CHAT_NOT_FOUND_TEXT, parse_mode="Markdown")
         await state.clear()
         return
-        
+
     # Создаем новый чат с тем же названием и моделью, но без истории
     new_chat = await db.create_chat(
         user_id=user.telegram_id,
@@ -608,8 +812,8 @@ async def clear_chat_history(message: Message, state: FSMContext, user: User) ->
         model=chat.model
     )
     
-    # Переключаем пользователя на новый чат
-    active_chats[user.telegram_id] = new_chat.id
+    # Переключаем пользователя на новый чат и сбрасываем кеш контекста
+    chat_context_cache.pop(chat_id, None)
     await state.update_data(chat_id=new_chat.id)
     
     await message.answer(
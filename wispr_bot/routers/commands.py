@@ -0,0 +1,46 @@
+from typing import Final
+
+from aiogram import Router
+from aiogram.methods import SendMessage
+from aiogram.types import Message
+from aiogram.filters import Command
+
+
+# Create router
+router = Router()
+
+# Returning the SendMessage object lets webhook mode serve the reply
+# inside the webhook HTTP response (no extra Bot API round-trip); in
+# polling mode the dispatcher executes it as a normal call.
+
+# Both replies are fully static, so the strings are built exactly once
+_START_TEXT: Final[str] = (
+    "👋 Добро пожаловать в Wispr Bot!\n\n"
+    "Я Telegram бот, который позволяет общаться с моделями OpenAI.\n\n"
+    "Используйте /help чтобы увидеть доступные команды."
+)
+
+_HELP_TEXT: Final[str] = (
+    "🔍 Доступные команды:\n\n"
+    "/newchat - Создать новый чат\n"
+    "/chats - Показать все чаты\n"
+    "/currentchat - Информация о текущем чате\n"
+    "/clear_history - Очистить историю текущего чата\n"
+    "/exit - Выйти из текущего чата\n"
+    "/image - Создать изображение по описанию\n"
+    "/settings - Настройки\n"
+    "/help - Показать справку\n\n"
+    "Просто отправьте сообщение, чтобы начать общение!"
+)
+
+
+@router.message(Command("start"))
+async def cmd_start(message: Message) -> SendMessage:
+    """Handle /start command."""
+    return SendMessage(chat_id=message.chat.id, text=_START_TEXT)
+
+
+@router.message(Command("help"))
+async def cmd_help(message: Message) -> SendMessage:
+    """Handle /help command."""
+    return SendMessage(chat_id=message.chat.id, text=_HELP_TEXT)
@@ -1,18 +1,17 @@
 from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery, BufferedInputFile
 from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-import os
+import base64
 import aiohttp
 import asyncio
-import tempfile
-import uuid
+from typing import Optional
 
 from ..utils.logger import logger
 from ..database.db import db
 from ..models.user import User
-from ..services.openai_service import OpenAIService
+from ..services.openai_service import get_openai_service
 
 # Create router
 router = Router()
@@ -22,9 +21,31 @@ class ImageGenStates(StatesGroup):
     """States for image generation operations."""
     waiting_for_prompt = State()
 
-# Temporary storage for downloaded images
-TEMP_DIR = os.path.join(tempfile.gettempdir(), "wispr_bot_images")
-os.makedirs(TEMP_DIR, exist_ok=True)
+# Shared HTTP session for image downloads: one warm connection pool with
+# DNS caching instead of a TCP/TLS handshake per download
+_session: Optional[aiohttp.ClientSession] = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Get the shared download session, creating it in the running loop."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=32, ttl_dns_cache=300, keepalive_timeout=60
+            ),
+            # Non-2xx raises ClientResponseError; no per-request status branch
+            raise_for_status=True,
+        )
+    return _session
+
+
+async def close_session() -> None:
+    """Close the shared download session on shutdown."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
 @router.message(Command("image"))
 async def image_command(message: Message, state: FSMContext, user: User, command: CommandObject) -> None:
@@ -60,6 +81,17 @@ async def process_image_prompt(message: Message, state: FSMContext, user: User)
     # Generate image
     await generate_image(message, user, prompt)
 
+def _build_caption(prompt: str, revised: str) -> str:
+    """Build the photo caption, branching once on the revised prompt."""
+    if revised and revised != prompt:
+        return (
+            f"🖼️ *Изображение сгенерировано*\n\n"
+            f"*Запрос:* {prompt}\n"
+            f"*Улучшенный запрос:* {revised}"
+        )
+    return f"🖼️ *Изображение сгенерировано*\n\n*Запрос:* {prompt}"
+
+
 async def generate_image(message: Message, user: User, prompt: str) -> None:
     """Generate an image using DALL-E-3."""
     # Send typing action to indicate processing
@@ -72,74 +104,89 @@ async def generate_image(message: Message, user: User, prompt: str) -> None:
         parse_mode="Markdown"
     )
     
-    # Create OpenAI service
-    openai_service = OpenAIService(user.openai_api_key if user.has_custom_api_key else None)
+    # Get OpenAI service (cached per user, reuses the warm client)
+    openai_service = get_openai_service(user)
     
     # Generate image
     result = await openai_service.generate_image(prompt)
-    
+
     if result["success"]:
-        # Download the image
+        caption = _build_caption(prompt, result.get("revised_prompt", prompt))
+
+        # Inline image data: upload straight to Telegram, deleting the
+        # waiting message concurrently with the photo upload
+        if result.get("b64_json"):
+            try:
+                photo = BufferedInputFile(
+                    base64.b64decode(result["b64_json"]), filename="image.png"
+                )
+                await asyncio.gather(
+                    message.bot.delete_message(
+                        chat_id=message.chat.id,
+                        message_id=waiting_msg.message_id
+                    ),
+                    message.answer_photo(photo, caption=caption, parse_mode="Markdown"),
+                )
+                logger.info(f"User {user.telegram_id} generated image with prompt: {prompt}")
+            except Exception as e:
+                logger.error(f"Error sending generated image: {e}")
+                await message.bot.edit_message_text(
+                    f"⚠️ *Ошибка при отправке изображения*: {e}",
+                    chat_id=message.chat.id,
+                    message_id=waiting_msg.message_id,
+                    parse_mode="Markdown"
+                )
+            return
+
+        # URL form: download the image and forward it. The waiting-message
+        # deletion is independent network I/O, so it runs concurrently
+        # with the download instead of after it
         image_url = result["url"]
-        revised_prompt = result.get("revised_prompt", prompt)
-        
-        try:
-            # Generate a unique filename
-            filename = f"{uuid.uuid4()}.png"
-            filepath = os.path.join(TEMP_DIR, filename)
-            
-            # Download the image
-            async with aiohttp.ClientSession() as session:
-                async with session.get(image_url) as response:
-                    if response.status == 200:
-                        with open(filepath, "wb") as f:
-                            f.write(await response.read())
-                    else:
-                        raise Exception(f"Failed to download image: {response.status}")
-            
-            # Send the image
-            photo = FSInputFile(filepath)
-            
-            # Delete waiting message
-            await message.bot.delete_message(
+        delete_task = asyncio.create_task(
+            message.bot.delete_message(
                 chat_id=message.chat.id,
                 message_id=waiting_msg.message_id
             )
-            
-            # Send image with caption
-            await message.answer_photo(
-                photo,
-                caption=(
-                    f"🖼️ *Изображение сгенерировано*\n\n"
-                    f"*Запрос:* {prompt}\n"
-                    f"{f'*Улучшенный запрос:* {revised_prompt}' if revised_prompt != prompt else ''}"
-                ),
-                parse_mode="Markdown"
-            )
-            
-            # Clean up the file
+        )
+
+        try:
+            # Download the image over the shared session, accumulating
+            # 64 KiB blocks in memory, and upload straight to Telegram —
+            # no temp file, no cleanup path
+            session = get_session()
+            async with session.get(image_url) as response:
+                # Non-2xx already raised ClientResponseError here
+                buffer = bytearray()
+                async for chunk in response.content.iter_chunked(65536):
+                    buffer.extend(chunk)
+
+            # The filename is only cosmetic for a Telegram upload — no
+            # uniqueness needed, so no per-image uuid4 (urandom read)
+            photo = BufferedInputFile(bytes(buffer), filename="image.png")
+
+            # Make sure the waiting message is gone (tolerate already-deleted)
             try:
-                os.remove(filepath)
+                await delete_task
             except Exception as e:
-                logger.error(f"Error deleting temporary file: {e}")
-                
+                logger.warning(f"Error deleting waiting message: {e}")
+
+            # Send image with caption
+            await message.answer_photo(photo, caption=caption, parse_mode="Markdown")
+
             logger.info(f"User {user.telegram_id} generated image with prompt: {prompt}")
-            
+
         except Exception as e:
             logger.error(f"Error downloading or sending image: {e}")
-            
-            # Delete waiting message
-            await message.bot.delete_message(
-                chat_id=message.chat.id,
-                message_id=waiting_msg.message_id
-            )
-            
+
+            # Make sure the waiting message is gone (tolerate already-deleted)
+            try:
+                await delete_task
+            except Exception:
+                pass
+
             # Send image URL instead
             await message.answer(
-                f"🖼️ *Изображение сгенерировано*\n\n"
-                f"*Запрос:* {prompt}\n"
-                f"{f'*Улучшенный запрос:* {revised_prompt}' if revised_prompt != prompt else ''}\n\n"
-                f"[Ссылка на изображение]({image_url})",
+                f"{caption}\n\n[Ссылка на изображение]({image_url})",
                 parse_mode="Markdown"
             )
     else:
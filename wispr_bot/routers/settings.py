@@ -8,13 +8,19 @@ from ..utils.logger import logger
 from ..database.db import db
 from ..models.user import User
 from ..config import config
-from ..services.openai_service import OpenAIService
+from ..services.openai_service import service_for_key
 
 
 # Create router
 router = Router()
 
 
+# The model list is static for the process lifetime, so both renderings
+# are built once at import instead of per /setmodel
+_MODELS_BULLETS = "\n".join(f"• {model}" for model in config.available_models)
+_MODELS_CSV = ", ".join(config.available_models)
+
+
 # FSM States
 class SettingsStates(StatesGroup):
     """States for settings operations."""
@@ -68,8 +74,8 @@ async def process_api_key(message: Message, state: FSMContext, user: User) -> No
     # Get API key from message
     api_key = message.text.strip()
     
-    # Create OpenAI service to validate the key
-    openai_service = OpenAIService()
+    # Validate the key via the cached default-key service
+    openai_service = service_for_key()
     is_valid = await openai_service.validate_api_key(api_key)
     
     if not is_valid:
@@ -108,10 +114,8 @@ async def remove_api_key(message: Message, user: User) -> None:
 @router.message(Command("setmodel"))
 async def set_model_command(message: Message, state: FSMContext) -> None:
     """Start the process to set user's preferred model."""
-    models_list = "\n".join([f"• {model}" for model in config.available_models])
-    
     await message.answer(
-        f"🤖 Пожалуйста, выберите предпочитаемую модель ChatGPT:\n\n{models_list}\n\n"
+        f"🤖 Пожалуйста, выберите предпочитаемую модель ChatGPT:\n\n{_MODELS_BULLETS}\n\n"
         f"Просто отправьте название модели (например, {config.default_model}).\n"
         f"Вы можете отменить эту операцию командой /cancel"
     )
@@ -134,10 +138,9 @@ async def process_model_selection(message: Message, state: FSMContext, user: Use
     selected_model = message.text.strip()
     
     # Validate model
-    if selected_model not in config.available_models:
-        models_list = ", ".join(config.available_models)
+    if selected_model not in config.available_models_set:
         await message.answer(
-            f"❌ Неверная модель. Пожалуйста, выберите из: {models_list} или /cancel"
+            f"❌ Неверная модель. Пожалуйста, выберите из: {_MODELS_CSV} или /cancel"
         )
         return
     
@@ -1,106 +1,388 @@
 import asyncio
-from typing import List, Dict, Optional, AsyncGenerator
+import functools
+import hashlib
+import time
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import List, Dict, Final, Optional, AsyncGenerator, Tuple
+from weakref import WeakValueDictionary
+import aiohttp
 import openai
+import orjson
 from openai import AsyncOpenAI
 
 from ..utils.logger import logger
 from ..config import config
 
 
+# Инструкция по Markdown собирается один раз на импорт, а не на каждый
+# вызов API. Сам словарь никогда не мутируется: в списки сообщений
+# вставляется его поверхностная копия.
+_MARKDOWN_SYSTEM_CONTENT = (
+    "Пожалуйста, используйте Markdown для форматирования текста. "
+    "Telegram поддерживает следующие элементы Markdown: "
+    "*курсив*, **жирный**, `код`, ```предварительно отформатированный код```, "
+    "[текст ссылки](URL). Обратите внимание, что символы '_', '*', '`', '[' "
+    "должны быть экранированы с помощью '\\', если они не используются для форматирования."
+)
+_MARKDOWN_SYSTEM_MSG = {"role": "system", "content": _MARKDOWN_SYSTEM_CONTENT}
+
+# Важно для серверного prompt caching: подготовка сообщений детерминирована
+# (инструкция всегда одна и та же, вставляется в одно и то же место,
+# пустой контент всегда чинится одинаково), так что префикс диалога
+# остаётся токен-в-токен одинаковым между ходами и кешируется провайдером
+# автоматически. Явные cache_control-маркеры — это Anthropic-расширение,
+# chat completions API OpenAI их не принимает.
+
+# Дельты стрима склеиваются перед yield: не чаще, чем раз в интервал,
+# либо когда накопилось достаточно символов. Потребитель и так не может
+# редактировать сообщение чаще, так что yield на каждый токен — лишние
+# переключения
+_STREAM_YIELD_MIN_CHARS = 64
+_STREAM_YIELD_INTERVAL = 0.8  # seconds
+
+# Канонические тексты ошибок: ветки возвращают один и тот же объект
+# строки вместо пересборки литерала, и все пользовательские тексты
+# ошибок собраны в одном месте
+_ERR_EMPTY_MESSAGES: Final = "⚠️ Ошибка: Пустой массив сообщений для API"
+_ERR_BAD_FORMAT: Final = "⚠️ Ошибка: Некорректный формат сообщения"
+_ERR_EMPTY_CHOICES: Final = "⚠️ Ошибка: API вернуло пустой ответ"
+_ERR_EMPTY_CONTENT: Final = "⚠️ Пустой ответ от API"
+_ERR_RATE_LIMIT: Final = (
+    "⚠️ Превышен лимит запросов к OpenAI. Пожалуйста, попробуйте позже."
+)
+_ERR_AUTH: Final = (
+    "⚠️ API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ."
+)
+
+# Диспетчеризация известных статусов одной выборкой из словаря вместо
+# цепочки сравнений в обоих чат-путях
+_STATUS_MSG: Final = MappingProxyType({
+    429: _ERR_RATE_LIMIT,
+    401: _ERR_AUTH,
+    403: _ERR_AUTH,
+})
+# У ошибок генерации изображений исторически свои тексты без префикса
+_IMAGE_STATUS_MSG: Final = MappingProxyType({
+    429: "Превышен лимит запросов к OpenAI. Пожалуйста, попробуйте позже.",
+    401: "API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ.",
+    403: "API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ.",
+})
+
+# Под нагрузкой лучше подождать свободный слот, чем заплатить полную
+# латентность запроса и всё равно получить RateLimitError. Стриминг
+# ограничивается отдельным семафором на уровне обработчика чата.
+_CHAT_SEM = asyncio.Semaphore(config.max_concurrent_chat)
+_IMAGE_SEM = asyncio.Semaphore(config.max_concurrent_image)
+
+
+class _RateLimiter:
+    """Клиентский токен-бакет по RPM и TPM для chat completions.
+
+    Запрос ждёт, пока в обоих бакетах хватит ёмкости, вместо того чтобы
+    заплатить полный round-trip и получить 429. Бакеты пополняются
+    лениво по прошедшему времени — фоновая задача не нужна; ожидающие
+    сериализуются на локе, так что очередь примерно FIFO.
+    """
+
+    def __init__(self, rpm: int, tpm: int):
+        self._rpm = rpm
+        self._tpm = tpm
+        self._req_budget = float(rpm)
+        self._tok_budget = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._req_budget = min(
+            float(self._rpm), self._req_budget + elapsed * self._rpm / 60.0
+        )
+        self._tok_budget = min(
+            float(self._tpm), self._tok_budget + elapsed * self._tpm / 60.0
+        )
+
+    async def acquire(self, tokens: int = 0, requests: int = 1) -> None:
+        """Block until the budget covers the request, then spend it."""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._req_budget >= requests and self._tok_budget >= tokens:
+                    self._req_budget -= requests
+                    self._tok_budget -= tokens
+                    return
+                wait_req = max(
+                    0.0, (requests - self._req_budget) * 60.0 / self._rpm
+                )
+                wait_tok = (
+                    max(0.0, (tokens - self._tok_budget) * 60.0 / self._tpm)
+                    if tokens else 0.0
+                )
+                await asyncio.sleep(max(wait_req, wait_tok))
+
+
+_rate_limiter = _RateLimiter(
+    config.max_requests_per_minute, config.max_tokens_per_minute
+)
+
+
+def _estimate_tokens(msgs: List[Dict[str, str]]) -> int:
+    """Rough prompt-token estimate (~4 chars per token) plus completion cap."""
+    return sum(len(m['content']) for m in msgs) // 4 + 1000
+
+# Успешные валидации ключей кешируются на час (повторная вставка того же
+# ключа — обычное дело), чтобы не гонять models.list по HTTPS каждый
+# раз. Хранятся только SHA-256 хеши ключей, не сами ключи.
+_VALID_KEY_TTL = 3600.0  # seconds
+_VALID_KEYS_MAX = 256
+_valid_keys: Dict[str, float] = {}
+
+# Чат-комплишены ходят мимо SDK: общий aiohttp-сеанс с прогретым пулом
+# соединений держит хвостовые задержки под нагрузкой лучше, чем httpx
+# внутри openai-клиента. Ключ передаётся в заголовке per-request, так
+# что один сеанс обслуживает всех пользователей. SDK остаётся для
+# генерации изображений и валидации ключей (не горячие пути).
+_OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+_OPENAI_MODELS_URL = "https://api.openai.com/v1/models"
+
+# Сэмплинг-параметры одни на оба пути (sync и stream); шаблон собирается
+# один раз и только распаковывается в payload. MappingProxyType защищает
+# от случайной мутации. top_p/frequency_penalty/presence_penalty равны
+# дефолтам API и не передаются вовсе.
+_DEFAULT_PARAMS = MappingProxyType({
+    "temperature": 0.7,
+    "max_tokens": 1000,
+})
+_http_session: Optional[aiohttp.ClientSession] = None
+
+
+def _get_http_session() -> aiohttp.ClientSession:
+    """Get the shared chat-completions session, creating it lazily."""
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=100, limit_per_host=100, ttl_dns_cache=300
+            ),
+            timeout=aiohttp.ClientTimeout(total=60),
+            json_serialize=lambda value: orjson.dumps(value).decode(),
+        )
+    return _http_session
+
+
+async def close_http_session() -> None:
+    """Close the shared chat-completions session on shutdown."""
+    global _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+
+# Кеш точных совпадений для нестримингового generate_response: ретраи и
+# повторные идентичные истории отвечают из памяти без сетевого вызова.
+# Хранятся Future, поэтому конкурирующие одинаковые запросы ждут один
+# общий вызов API вместо N параллельных. Ошибки не кешируются.
+# Семантический слой (embedding + ANN поверх последнего сообщения)
+# сознательно не добавлен: ответ зависит от всей истории чата, и
+# совпадение одной реплики не гарантирует совпадение ответа.
+_RESPONSE_CACHE_MAX = 512
+_response_cache: "OrderedDict[bytes, asyncio.Future]" = OrderedDict()
+
+
+def _response_cache_key(model: str, msgs: List[Dict[str, str]]) -> bytes:
+    """Compact digest of everything that determines a completion.
+
+    Sampling parameters are fixed per call site, so model plus the
+    (role, content) sequence fully identifies the request.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(orjson.dumps([model, [(m['role'], m['content']) for m in msgs]]))
+    return h.digest()
+
+
+def _resolve_failed_response(text: str, cache_key: Optional[bytes],
+                             fut: "Optional[asyncio.Future]") -> str:
+    """Hand an error text to any waiters and drop it from the cache."""
+    if fut is not None and not fut.done():
+        _response_cache.pop(cache_key, None)
+        fut.set_result(text)
+    return text
+
+
+# SDK-клиенты (теперь только генерация изображений и не-горячие пути)
+# шарятся по API-ключу: без этого каждый пользователь на дефолтном ключе
+# получал собственный AsyncOpenAI с собственным httpx-пулом и TLS.
+# WeakValueDictionary: клиент жив, пока на него ссылается хоть один
+# сервис, и уходит вместе с последним.
+_sdk_clients: "WeakValueDictionary[str, AsyncOpenAI]" = WeakValueDictionary()
+
+
+def _sdk_client_for_key(api_key: str) -> AsyncOpenAI:
+    """Get (or build) the shared SDK client for an API key."""
+    client = _sdk_clients.get(api_key)
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key)
+        _sdk_clients[api_key] = client
+    return client
+
+
 class OpenAIService:
     """Service for interacting with OpenAI API."""
-    
+
     def __init__(self, api_key: Optional[str] = None):
         """Initialize OpenAI client with API key."""
         self.api_key = api_key or config.openai_api_key
-        self.client = AsyncOpenAI(api_key=self.api_key)
-    
+        self.client = _sdk_client_for_key(self.api_key)
+
     def update_api_key(self, api_key: str) -> None:
         """Update API key and reinitialize client."""
         self.api_key = api_key
-        self.client = AsyncOpenAI(api_key=self.api_key)
+        self.client = _sdk_client_for_key(self.api_key)
     
     async def generate_response(
         self, 
         messages: List[Dict[str, str]], 
         model: str = "gpt-3.5-turbo"
     ) -> str:
-        """Generate response from OpenAI API."""
+        """Generate response from OpenAI API.
+
+        Identical (model, messages) requests are served from an in-process
+        cache; concurrent duplicates await one shared API call.
+        """
+        cache_key: Optional[bytes] = None
+        fut: Optional[asyncio.Future] = None
         try:
             # Проверка на пустой массив сообщений
             if not messages:
                 logger.error("Empty messages array provided to OpenAI API")
-                return "⚠️ Ошибка: Пустой массив сообщений для API"
+                return _ERR_EMPTY_MESSAGES
                 
             # Validate model
-            if model not in config.available_models:
+            if model not in config.available_models_set:
                 model = config.default_model
-                logger.warning(f"Invalid model requested. Using default: {model}")
-            
-            # Добавляем системное сообщение с инструкцией по использованию Markdown
-            system_message = {
-                "role": "system",
-                "content": "Пожалуйста, используйте Markdown для форматирования текста. "
-                           "Telegram поддерживает следующие элементы Markdown: "
-                           "*курсив*, **жирный**, `код`, ```предварительно отформатированный код```, "
-                           "[текст ссылки](URL). Обратите внимание, что символы '_', '*', '`', '[' "
-                           "должны быть экранированы с помощью '\\', если они не используются для форматирования."
-            }
-            
-            # Проверяем, есть ли уже системное сообщение
-            has_system_message = False
-            for msg in messages:
-                if msg.get('role') == 'system':
-                    # Если есть системное сообщение, дополняем его инструкцией по Markdown
-                    msg['content'] += " " + system_message['content']
-                    has_system_message = True
-                    break
-            
-            # Если нет системного сообщения, добавляем его в начало
-            if not has_system_message:
-                messages.insert(0, system_message)
-            
-            # Проверяем каждое сообщение на корректность
-            for i, msg in enumerate(messages):
-                if 'role' not in msg or 'content' not in msg:
-                    logger.error(f"Invalid message format at index {i}: {msg}")
-                    return "⚠️ Ошибка: Некорректный формат сообщения"
-                
-                if not msg['content']:
-                    logger.warning(f"Empty content in message at index {i}")
-                    messages[i]['content'] = " "  # Заменяем пустую строку на пробел
-            
-            # Call OpenAI API
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1000,
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
+                logger.warning("Invalid model requested. Using default: {}", model)
+
+            # Один проход-комприхеншен строит чистую копию payload (пустой
+            # контент заменяется пробелом), не мутируя список вызывающего
+            # кода. Формат проверяется через KeyError: на happy path это
+            # дешевле, чем членство по двум ключам на каждый элемент
+            try:
+                msgs = [
+                    {"role": m["role"], "content": m["content"] or " "}
+                    for m in messages
+                ]
+            except KeyError as e:
+                logger.error("Invalid message format: missing {}", e)
+                return _ERR_BAD_FORMAT
+
+            sys_idx = next(
+                (i for i, m in enumerate(msgs) if m["role"] == "system"), -1
             )
-            
+
+            # Дополняем существующее системное сообщение инструкцией по
+            # Markdown или вставляем её в начало. Если инструкция уже
+            # вшита (список переиспользуется между вызовами), ничего не
+            # добавляем — иначе системный промпт растёт с каждым ходом
+            if sys_idx >= 0:
+                if _MARKDOWN_SYSTEM_CONTENT not in msgs[sys_idx]['content']:
+                    msgs[sys_idx] = {
+                        **msgs[sys_idx],
+                        'content': msgs[sys_idx]['content'] + " " + _MARKDOWN_SYSTEM_CONTENT,
+                    }
+            else:
+                msgs.insert(0, dict(_MARKDOWN_SYSTEM_MSG))
+
+            # Короткое замыкание по точному совпадению: попадание отвечает
+            # без сетевого вызова, промах регистрирует Future до вызова,
+            # чтобы конкурирующие дубликаты ждали его, а не звонили сами
+            cache_key = _response_cache_key(model, msgs)
+            cached = _response_cache.get(cache_key)
+            if cached is not None:
+                _response_cache.move_to_end(cache_key)
+                return await cached
+
+            fut = asyncio.get_running_loop().create_future()
+            _response_cache[cache_key] = fut
+            if len(_response_cache) > _RESPONSE_CACHE_MAX:
+                _response_cache.popitem(last=False)
+
+            # Call OpenAI API directly over the shared aiohttp session
+            payload = {"model": model, "messages": msgs, **_DEFAULT_PARAMS}
+            await _rate_limiter.acquire(tokens=_estimate_tokens(msgs))
+            async with _CHAT_SEM:
+                async with _get_http_session().post(
+                    _OPENAI_CHAT_URL,
+                    json=payload,
+                    headers={"Authorization": f"Bearer {self.api_key}"},
+                ) as resp:
+                    if resp.status != 200:
+                        msg = _STATUS_MSG.get(resp.status)
+                        if msg is None:
+                            body = await resp.text()
+                            logger.error("OpenAI API error {}: {}", resp.status, body[:200])
+                            msg = f"⚠️ Ошибка соединения с OpenAI: HTTP {resp.status}"
+                        else:
+                            logger.error("OpenAI API error {}", resp.status)
+                        return _resolve_failed_response(msg, cache_key, fut)
+                    data = await resp.json(loads=orjson.loads)
+
             # Проверяем, что есть ответ
-            if not response.choices or len(response.choices) == 0:
+            if not data.get("choices"):
                 logger.error("OpenAI returned empty choices")
-                return "⚠️ Ошибка: API вернуло пустой ответ"
-                
+                return _resolve_failed_response(_ERR_EMPTY_CHOICES, cache_key, fut)
+
             # Extract and return response text
-            return response.choices[0].message.content or "⚠️ Пустой ответ от API"
-            
-        except openai.RateLimitError:
-            logger.error("OpenAI rate limit exceeded")
-            return "⚠️ Превышен лимит запросов к OpenAI. Пожалуйста, попробуйте позже."
-            
-        except openai.AuthenticationError:
-            logger.error("OpenAI authentication error")
-            return "⚠️ API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ."
-            
+            result = data["choices"][0]["message"].get("content")
+            if not result:
+                return _resolve_failed_response(_ERR_EMPTY_CONTENT, cache_key, fut)
+            fut.set_result(result)
+            return result
+
         except Exception as e:
-            logger.error(f"OpenAI API error: {str(e)}")
-            return f"⚠️ Ошибка соединения с OpenAI: {str(e)}"
-    
+            # repr исключения и стек формируются в фоновом потоке синка,
+            # не на event loop
+            logger.opt(exception=True).error("OpenAI API error")
+            return _resolve_failed_response(
+                f"⚠️ Ошибка соединения с OpenAI: {str(e)}", cache_key, fut
+            )
+        finally:
+            # CancelledError — это BaseException и проходит мимо except
+            # Exception: если лидера отменили, его Future нельзя оставить
+            # в кеше, иначе все последующие идентичные запросы зависнут
+            # на await навсегда
+            if fut is not None and not fut.done():
+                _response_cache.pop(cache_key, None)
+                fut.cancel()
+
+    async def generate_responses_batch(
+        self,
+        batches: List[List[Dict[str, str]]],
+        model: str = "gpt-3.5-turbo",
+        max_concurrency: int = 20,
+    ) -> List[str]:
+        """Generate responses for several independent message lists at once.
+
+        Chat completions не умеют нести несколько независимых историй в
+        одном запросе (n= даёт варианты одного промпта), поэтому батч
+        уходит веером через bounded gather: TLS/пул соединений общие,
+        а паралеллизм ограничен, чтобы не выбить RPM-лимит. Ошибки
+        отдельных элементов возвращаются их текстами, не роняя весь батч.
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _one(msgs: List[Dict[str, str]]) -> str:
+            async with sem:
+                return await self.generate_response(msgs, model)
+
+        results = await asyncio.gather(
+            *(_one(msgs) for msgs in batches), return_exceptions=True
+        )
+        return [
+            r if isinstance(r, str) else f"⚠️ Ошибка соединения с OpenAI: {r}"
+            for r in results
+        ]
+
     async def generate_response_stream(
         self, 
         messages: List[Dict[str, str]], 
@@ -108,94 +390,127 @@ class OpenAIService:
     ) -> AsyncGenerator[str, None]:
         """
         Generate streaming response from OpenAI API.
-        Returns an async generator that yields chunks of the response as they arrive.
+        Returns an async generator that yields text deltas as they
+        arrive; the caller accumulates them into the full response.
+        Yielding the growing buffer instead would make the stream O(n²)
+        in total characters.
         """
         try:
             # Проверка на пустой массив сообщений
             if not messages:
                 logger.error("Empty messages array provided to OpenAI API")
-                yield "⚠️ Ошибка: Пустой массив сообщений для API"
+                yield _ERR_EMPTY_MESSAGES
                 return
                 
             # Validate model
-            if model not in config.available_models:
+            if model not in config.available_models_set:
                 model = config.default_model
-                logger.warning(f"Invalid model requested. Using default: {model}")
+                logger.warning("Invalid model requested. Using default: {}", model)
             
-            # Добавляем системное сообщение с инструкцией по использованию Markdown
-            system_message = {
-                "role": "system",
-                "content": "Пожалуйста, используйте Markdown для форматирования текста. "
-                           "Telegram поддерживает следующие элементы Markdown: "
-                           "*курсив*, **жирный**, `код`, ```предварительно отформатированный код```, "
-                           "[текст ссылки](URL). Обратите внимание, что символы '_', '*', '`', '[' "
-                           "должны быть экранированы с помощью '\\', если они не используются для форматирования."
+            # Один проход-комприхеншен строит чистую копию payload (пустой
+            # контент заменяется пробелом), не мутируя список вызывающего
+            # кода. Формат проверяется через KeyError: на happy path это
+            # дешевле, чем членство по двум ключам на каждый элемент
+            try:
+                msgs = [
+                    {"role": m["role"], "content": m["content"] or " "}
+                    for m in messages
+                ]
+            except KeyError as e:
+                logger.error("Invalid message format: missing {}", e)
+                yield _ERR_BAD_FORMAT
+                return
+
+            sys_idx = next(
+                (i for i, m in enumerate(msgs) if m["role"] == "system"), -1
+            )
+
+            # Дополняем существующее системное сообщение инструкцией по
+            # Markdown или вставляем её в начало. Если инструкция уже
+            # вшита (список переиспользуется между вызовами), ничего не
+            # добавляем — иначе системный промпт растёт с каждым ходом
+            if sys_idx >= 0:
+                if _MARKDOWN_SYSTEM_CONTENT not in msgs[sys_idx]['content']:
+                    msgs[sys_idx] = {
+                        **msgs[sys_idx],
+                        'content': msgs[sys_idx]['content'] + " " + _MARKDOWN_SYSTEM_CONTENT,
+                    }
+            else:
+                msgs.insert(0, dict(_MARKDOWN_SYSTEM_MSG))
+
+            # Call OpenAI API with streaming over the shared aiohttp
+            # session, parsing the SSE lines ourselves
+            payload = {
+                "model": model,
+                "messages": msgs,
+                "stream": True,
+                **_DEFAULT_PARAMS,
             }
-            
-            # Проверяем, есть ли уже системное сообщение
-            has_system_message = False
-            for msg in messages:
-                if msg.get('role') == 'system':
-                    # Если есть системное сообщение, дополняем его инструкцией по Markdown
-                    msg['content'] += " " + system_message['content']
-                    has_system_message = True
-                    break
-            
-            # Если нет системного сообщения, добавляем его в начало
-            if not has_system_message:
-                messages.insert(0, system_message)
-            
-            # Проверяем каждое сообщение на корректность
-            for i, msg in enumerate(messages):
-                if 'role' not in msg or 'content' not in msg:
-                    logger.error(f"Invalid message format at index {i}: {msg}")
-                    yield "⚠️ Ошибка: Некорректный формат сообщения"
+            await _rate_limiter.acquire(tokens=_estimate_tokens(msgs))
+            async with _get_http_session().post(
+                _OPENAI_CHAT_URL,
+                json=payload,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            ) as resp:
+                if resp.status != 200:
+                    msg = _STATUS_MSG.get(resp.status)
+                    if msg is None:
+                        body = await resp.text()
+                        logger.error("OpenAI API error {}: {}", resp.status, body[:200])
+                        msg = f"⚠️ Ошибка соединения с OpenAI: HTTP {resp.status}"
+                    else:
+                        logger.error("OpenAI API error {}", resp.status)
+                    yield msg
                     return
-                
-                if not msg['content']:
-                    logger.warning(f"Empty content in message at index {i}")
-                    messages[i]['content'] = " "  # Заменяем пустую строку на пробел
-            
-            # Call OpenAI API with streaming
-            stream = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=0.7,
-                max_tokens=1000,
-                stream=True,  # Enable streaming
-                top_p=1.0,
-                frequency_penalty=0.0,
-                presence_penalty=0.0
-            )
-            
-            # Process the streaming response
-            full_response = ""
-            async for chunk in stream:
-                if not chunk.choices or len(chunk.choices) == 0:
-                    continue
-                
-                delta = chunk.choices[0].delta
-                if not delta or not hasattr(delta, "content") or not delta.content:
-                    continue
-                
-                full_response += delta.content
-                yield full_response
-            
+
+                # Process the streaming response, coalescing deltas so the
+                # caller wakes up per batch instead of per token
+                got_content = False
+                pending: List[str] = []
+                pending_len = 0
+                last_emit = time.monotonic()
+                async for raw_line in resp.content:
+                    line = raw_line.strip()
+                    if not line.startswith(b"data: "):
+                        continue
+                    data_bytes = line[6:]
+                    if data_bytes == b"[DONE]":
+                        break
+
+                    chunk = orjson.loads(data_bytes)
+                    choices = chunk.get("choices")
+                    if not choices:
+                        continue
+
+                    content = choices[0].get("delta", {}).get("content")
+                    if not content:
+                        continue
+
+                    got_content = True
+                    pending.append(content)
+                    pending_len += len(content)
+
+                    now = time.monotonic()
+                    if (
+                        pending_len >= _STREAM_YIELD_MIN_CHARS
+                        or now - last_emit >= _STREAM_YIELD_INTERVAL
+                    ):
+                        yield "".join(pending)
+                        pending.clear()
+                        pending_len = 0
+                        last_emit = now
+
+                # Flush whatever is left when the stream ends
+                if pending:
+                    yield "".join(pending)
+
             # If we didn't get any content, yield an error
-            if not full_response:
+            if not got_content:
                 logger.error("OpenAI returned empty streaming response")
-                yield "⚠️ Ошибка: API вернуло пустой ответ"
+                yield _ERR_EMPTY_CHOICES
                 
-        except openai.RateLimitError:
-            logger.error("OpenAI rate limit exceeded")
-            yield "⚠️ Превышен лимит запросов к OpenAI. Пожалуйста, попробуйте позже."
-            
-        except openai.AuthenticationError:
-            logger.error("OpenAI authentication error")
-            yield "⚠️ API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ."
-            
         except Exception as e:
-            logger.error(f"OpenAI API streaming error: {str(e)}")
+            logger.opt(exception=True).error("OpenAI API streaming error")
             yield f"⚠️ Ошибка соединения с OpenAI: {str(e)}"
     
     async def generate_image(self, prompt: str, size: str = "1024x1024", model: str = "dall-e-3") -> Dict:
@@ -211,76 +526,145 @@ class OpenAIService:
             Dict containing success status, url if successful, or error message
         """
         try:
-            logger.info(f"Generating image with prompt: {prompt}")
+            logger.info("Generating image with prompt: {}", prompt)
             
             # Validate size parameter
             valid_sizes = ["1024x1024", "1792x1024", "1024x1792"]
             if size not in valid_sizes:
-                logger.warning(f"Invalid size: {size}. Using default 1024x1024")
+                logger.warning("Invalid size: {}. Using default 1024x1024", size)
                 size = "1024x1024"
             
-            # Call the images API
-            response = await self.client.images.generate(
-                model=model,
-                prompt=prompt,
-                size=size,
-                quality="standard",
-                n=1,
-            )
-            
-            if not response.data or len(response.data) == 0:
+            # Call the images API; b64_json returns the bytes inline so
+            # the bot can upload straight to Telegram without Telegram
+            # fetching the URL from OpenAI first
+            async with _IMAGE_SEM:
+                response = await self.client.images.generate(
+                    model=model,
+                    prompt=prompt,
+                    size=size,
+                    quality="standard",
+                    response_format="b64_json",
+                    n=1,
+                )
+
+            if not response.data:
                 logger.error("OpenAI returned empty image data")
                 return {
                     "success": False,
                     "error": "Получен пустой ответ от API при генерации изображения"
                 }
-            
-            # Extract and return the image URL
+
+            # Prefer inline image data; fall back to the URL form
+            image_b64 = getattr(response.data[0], "b64_json", None)
+            if image_b64:
+                return {
+                    "success": True,
+                    "b64_json": image_b64,
+                    "revised_prompt": getattr(response.data[0], "revised_prompt", prompt)
+                }
+
             image_url = response.data[0].url
             if not image_url:
-                logger.error("No image URL in response")
+                logger.error("No image data or URL in response")
                 return {
                     "success": False,
-                    "error": "URL изображения отсутствует в ответе API"
+                    "error": "Изображение отсутствует в ответе API"
                 }
-                
+
             return {
                 "success": True,
                 "url": image_url,
                 "revised_prompt": getattr(response.data[0], "revised_prompt", prompt)
             }
             
-        except openai.RateLimitError:
-            logger.error("OpenAI rate limit exceeded during image generation")
-            return {
-                "success": False,
-                "error": "Превышен лимит запросов к OpenAI. Пожалуйста, попробуйте позже."
-            }
-            
-        except openai.AuthenticationError:
-            logger.error("OpenAI authentication error during image generation")
+        except openai.APIStatusError as e:
+            # Один перехват со словарной диспетчеризацией по статусу вместо
+            # цепочки типизированных except (у ошибок изображений свои
+            # тексты без префикса "⚠️")
+            logger.error("OpenAI image generation error {}", e.status_code)
             return {
                 "success": False,
-                "error": "API ключ OpenAI недействителен. Пожалуйста, проверьте ваш API ключ."
+                "error": _IMAGE_STATUS_MSG.get(
+                    e.status_code, f"Ошибка при генерации изображения: {e}"
+                )
             }
-            
+
         except Exception as e:
-            logger.error(f"OpenAI image generation error: {str(e)}")
+            logger.opt(exception=True).error("OpenAI image generation error")
             return {
                 "success": False,
                 "error": f"Ошибка при генерации изображения: {str(e)}"
             }
     
     async def validate_api_key(self, api_key: str) -> bool:
-        """Validate OpenAI API key."""
+        """Validate OpenAI API key, caching positive results for an hour."""
+        key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+        validated_at = _valid_keys.get(key_hash)
+        if validated_at is not None and time.monotonic() - validated_at < _VALID_KEY_TTL:
+            return True
+
         try:
-            # Create a temporary client with the provided key
-            client = AsyncOpenAI(api_key=api_key)
-            
-            # Make a simple request to validate the key
-            await client.models.list()
-            
+            # Лёгкий пробник поверх общего сеанса: GET /v1/models с ключом
+            # кандидата в заголовке, без сборки одноразового AsyncOpenAI
+            # (и его httpx-пула) ради одного запроса
+            async with _get_http_session().get(
+                _OPENAI_MODELS_URL,
+                headers={"Authorization": f"Bearer {api_key}"},
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as resp:
+                if resp.status != 200:
+                    logger.error("API key validation failed: HTTP {}", resp.status)
+                    return False
+
+            if len(_valid_keys) >= _VALID_KEYS_MAX:
+                # Drop the oldest entry to keep the map bounded
+                _valid_keys.pop(next(iter(_valid_keys)))
+            _valid_keys[key_hash] = time.monotonic()
             return True
-        except Exception as e:
-            logger.error(f"API key validation error: {str(e)}")
-            return False 
\ No newline at end of file
+        except Exception:
+            logger.opt(exception=True).error("API key validation error")
+            return False
+
+
+@functools.lru_cache(maxsize=256)
+def service_for_key(api_key: Optional[str] = None) -> OpenAIService:
+    """Get a cached service for an API key (None = the bot's default key).
+
+    One AsyncOpenAI client (and its httpx pool) per distinct key instead
+    of a fresh one per call; handy for key validation and other paths
+    that are not tied to a specific user.
+    """
+    return OpenAIService(api_key)
+
+
+# LRU cache of service instances so repeated messages from one user reuse
+# the same AsyncOpenAI client (and its warm connection pool to OpenAI)
+# instead of paying client construction plus a TLS handshake per message
+_service_cache: "OrderedDict[Tuple[int, bool], OpenAIService]" = OrderedDict()
+_SERVICE_CACHE_MAX = 1024
+
+
+def get_openai_service(user) -> OpenAIService:
+    """Get a cached OpenAIService for the user, creating one on first use.
+
+    Keyed by (telegram_id, has_custom_api_key); if the user's key changed
+    since the instance was cached, a fresh one replaces it.
+    """
+    key = (user.telegram_id, user.has_custom_api_key)
+    expected_api_key = (
+        user.openai_api_key if user.has_custom_api_key else config.openai_api_key
+    )
+
+    service = _service_cache.get(key)
+    if service is not None and service.api_key == expected_api_key:
+        _service_cache.move_to_end(key)
+        return service
+
+    service = OpenAIService(user.openai_api_key if user.has_custom_api_key else None)
+    _service_cache[key] = service
+    _service_cache.move_to_end(key)
+    if len(_service_cache) > _SERVICE_CACHE_MAX:
+        # SDK-клиент может шариться другими сервисами с тем же ключом,
+        # поэтому явно не закрывается: последний владелец утащит его в GC
+        _service_cache.popitem(last=False)
+    return service 
\ No newline at end of file
@@ -1,23 +1,16 @@
-import asyncio
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
 
+from aiogram.types import Message, CallbackQuery
+
 from ..models.user import User
 from ..models.chat import Chat, ChatMessage
 
 
-@pytest.fixture
-def event_loop():
-    """Create event loop for tests."""
-    loop = asyncio.get_event_loop_policy().new_event_loop()
-    yield loop
-    loop.close()
-
-
 @pytest.fixture
 def mock_message():
     """Create mock Message object."""
-    message = AsyncMock()
+    message = AsyncMock(spec=Message)
     message.from_user = MagicMock()
     message.from_user.id = 123456789
     message.from_user.username = "test_user"
@@ -36,7 +29,7 @@ def mock_message():
 @pytest.fixture
 def mock_callback_query():
     """Create mock CallbackQuery object."""
-    callback = AsyncMock()
+    callback = AsyncMock(spec=CallbackQuery)
     callback.from_user = MagicMock()
     callback.from_user.id = 123456789
     callback.from_user.username = "test_user"
@@ -95,9 +88,12 @@ def mock_chat():
 @pytest.fixture
 def mock_db():
     """Create mock Database object with AsyncMock methods."""
-    with patch("wispr_bot.database.db.db") as mock:
+    with patch("wispr_bot.middlewares.access.db") as mock:
         # Configure mock methods
         mock.get_user = AsyncMock()
+        mock.get_users_by_ids = AsyncMock(return_value=[])
+        mock.upsert_user_returning = AsyncMock()
+        mock.touch_user_last_active = AsyncMock()
         mock.create_or_update_user = AsyncMock()
         mock.get_chat = AsyncMock()
         mock.create_chat = AsyncMock()
@@ -112,6 +108,34 @@ def mock_db():
         yield mock
 
 
+def _fake_http_response(status: int, payload: dict):
+    """Build an async-context-manager mock mimicking an aiohttp response."""
+    resp = MagicMock()
+    resp.status = status
+    resp.json = AsyncMock(return_value=payload)
+    resp.text = AsyncMock(return_value="")
+    ctx = MagicMock()
+    ctx.__aenter__ = AsyncMock(return_value=resp)
+    ctx.__aexit__ = AsyncMock(return_value=False)
+    return ctx
+
+
+@pytest.fixture
+def openai_http_factory():
+    """Factory for fake shared sessions used by the direct OpenAI HTTP path.
+
+    Tests parametrize only the reply content (or status) instead of
+    rebuilding the whole mock tree inline.
+    """
+    def _make(content="ok", status=200):
+        payload = {"choices": [{"message": {"content": content}}]}
+        session = MagicMock()
+        session.post = MagicMock(return_value=_fake_http_response(status, payload))
+        session.get = MagicMock(return_value=_fake_http_response(status, payload))
+        return session
+    return _make
+
+
 @pytest.fixture
 def mock_openai_service():
     """Create mock OpenAIService object with AsyncMock methods."""
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 from unittest.mock import AsyncMock, patch
 
@@ -5,54 +7,107 @@ from ..middlewares.access import AccessMiddleware
 from ..models.user import User
 
 
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    """Reset the in-process user cache between tests."""
+    AccessMiddleware.user_cache.clear()
+    yield
+    AccessMiddleware.user_cache.clear()
+
+
 @pytest.mark.asyncio
 async def test_middleware_allowed_user(mock_message, mock_user, mock_db):
     """Test middleware with allowed user."""
     # Setup allowed user
     mock_user.is_allowed = True
-    
-    # Mock DB to return our user
-    mock_db.get_user.return_value = mock_user
-    
+
+    # Mock DB to return our user from the batched lookup
+    mock_db.get_users_by_ids.return_value = [mock_user]
+
     # Setup handler mock
     handler = AsyncMock()
     data = {}
-    
+
     # Create middleware
     middleware = AccessMiddleware()
-    
+
     # Call middleware
     await middleware(handler, mock_message, data)
-    
+
     # Verify handler was called
     handler.assert_called_once_with(mock_message, {"user": mock_user})
 
+    # Unchanged profile: only last_active is touched, no full upsert
+    mock_db.touch_user_last_active.assert_called_once_with(123456789)
+    mock_db.upsert_user_returning.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_middleware_profile_change_triggers_upsert(mock_message, mock_user, mock_db):
+    """Test that a changed username forces the full profile upsert."""
+    mock_user.is_allowed = True
+    mock_user.username = "old_name"
+    mock_db.get_users_by_ids.return_value = [mock_user]
+    mock_db.upsert_user_returning.return_value = mock_user
+
+    handler = AsyncMock()
+    middleware = AccessMiddleware()
+
+    await middleware(handler, mock_message, {})
+
+    mock_db.upsert_user_returning.assert_called_once()
+    mock_db.touch_user_last_active.assert_not_called()
+
 
 @pytest.mark.asyncio
 async def test_middleware_admin_user(mock_message, mock_user, mock_db):
     """Test middleware with admin user."""
-    # Setup non-allowed user
-    mock_user.is_allowed = False
-    
-    # Mock DB to return our user
-    mock_db.get_user.return_value = mock_user
-    
+    # The admin's stored profile (API key, model) comes from the DB row
+    mock_user.is_allowed = True
+    mock_db.get_users_by_ids.return_value = [mock_user]
+
     # Setup handler mock
     handler = AsyncMock()
     data = {}
-    
+
     # Create middleware
     middleware = AccessMiddleware()
-    
-    # Make sure user is in admin IDs
-    with patch("wispr_bot.middlewares.access.config") as mock_config:
-        mock_config.admin_user_ids = {123456789}  # Match our mock user ID
-        
+
+    # Make sure user is in admin IDs (bound at module level)
+    with patch("wispr_bot.middlewares.access._admin_ids", frozenset({123456789})):
+
         # Call middleware
         await middleware(handler, mock_message, data)
-        
-        # Verify handler was called
-        handler.assert_called_once_with(mock_message, {"user": mock_user})
+
+        # Verify handler was called with the real DB-backed user
+        handler.assert_called_once()
+        assert data["user"] is mock_user
+        assert data["user"].is_allowed is True
+
+        # The row is hydrated via the batching loader; last_active is
+        # refreshed in the background
+        mock_db.get_users_by_ids.assert_called_once()
+        mock_db.upsert_user_returning.assert_not_called()
+        await asyncio.sleep(0)  # Let the fire-and-forget touch run
+        mock_db.touch_user_last_active.assert_called_once_with(123456789)
+
+
+@pytest.mark.asyncio
+async def test_middleware_admin_profile_change_triggers_upsert(mock_message, mock_user, mock_db):
+    """Test that an admin's changed username forces the full upsert too."""
+    mock_user.is_allowed = True
+    mock_user.username = "old_name"
+    mock_db.get_users_by_ids.return_value = [mock_user]
+    mock_db.upsert_user_returning.return_value = mock_user
+
+    handler = AsyncMock()
+    middleware = AccessMiddleware()
+
+    with patch("wispr_bot.middlewares.access._admin_ids", frozenset({123456789})):
+        await middleware(handler, mock_message, {})
+
+    mock_db.upsert_user_returning.assert_called_once()
+    assert mock_db.upsert_user_returning.call_args[1]["is_allowed"] is True
 
 
 @pytest.mark.asyncio
@@ -60,94 +115,193 @@ async def test_middleware_disallowed_user(mock_message, mock_user, mock_db):
     """Test middleware with disallowed user."""
     # Setup non-allowed user
     mock_user.is_allowed = False
-    
-    # Mock DB to return our user
-    mock_db.get_user.return_value = mock_user
-    
+
+    # Mock DB to return our user from the batched lookup
+    mock_db.get_users_by_ids.return_value = [mock_user]
+
     # Setup handler mock
     handler = AsyncMock()
     data = {}
-    
+
     # Create middleware
     middleware = AccessMiddleware()
-    
+
     # Set admin IDs to not include our user
-    with patch("wispr_bot.middlewares.access.config") as mock_config:
-        mock_config.admin_user_ids = {999999}  # Different from our mock user ID
-        
+    with patch("wispr_bot.middlewares.access._admin_ids", frozenset({999999})):
+
         # Call middleware
         await middleware(handler, mock_message, data)
-        
+
         # Verify handler was NOT called
         handler.assert_not_called()
-        
+
         # Verify message.answer was called with unauthorized message
         mock_message.answer.assert_called_once()
         args = mock_message.answer.call_args[0]
-        assert "not allowed" in args[0]
+        assert "нет доступа" in args[0]
 
 
 @pytest.mark.asyncio
 async def test_middleware_new_user(mock_message, mock_db):
     """Test middleware with new user that doesn't exist in DB."""
-    # Mock DB to return None (user doesn't exist)
-    mock_db.get_user.return_value = None
-    
+    # The upsert creates the row and returns it
+    mock_db.upsert_user_returning.return_value = User(
+        telegram_id=123456789,
+        username="test_user",
+        is_allowed=False
+    )
+
     # Setup handler mock
     handler = AsyncMock()
     data = {}
-    
+
     # Create middleware
     middleware = AccessMiddleware()
-    
+
     # Set admin IDs to not include our user
-    with patch("wispr_bot.middlewares.access.config") as mock_config:
-        mock_config.admin_user_ids = {999999}  # Different from our mock user ID
-        
+    with patch("wispr_bot.middlewares.access._admin_ids", frozenset({999999})):
+
         # Call middleware
         await middleware(handler, mock_message, data)
-        
+
         # Verify handler was NOT called (user not allowed)
         handler.assert_not_called()
-        
-        # Verify create_or_update_user was called
-        mock_db.create_or_update_user.assert_called_once()
-        
-        # Get the user that was created
-        created_user = mock_db.create_or_update_user.call_args[0][0]
-        assert created_user.telegram_id == mock_message.from_user.id
-        assert created_user.username == mock_message.from_user.username
-        assert created_user.is_allowed is False
+
+        # Verify the upsert was issued with the event's profile fields
+        mock_db.upsert_user_returning.assert_called_once()
+        call_kwargs = mock_db.upsert_user_returning.call_args[1]
+        assert call_kwargs["telegram_id"] == mock_message.from_user.id
+        assert call_kwargs["username"] == mock_message.from_user.username
+        assert call_kwargs["is_allowed"] is False
 
 
 @pytest.mark.asyncio
 async def test_middleware_new_admin_user(mock_message, mock_db):
     """Test middleware with new admin user that doesn't exist in DB."""
-    # Mock DB to return None (user doesn't exist)
-    mock_db.get_user.return_value = None
-    
+    # No row yet: the upsert creates it, pre-allowed
+    mock_db.upsert_user_returning.return_value = User(
+        telegram_id=123456789,
+        username="test_user",
+        is_allowed=True
+    )
+
     # Setup handler mock
     handler = AsyncMock()
     data = {}
-    
+
     # Create middleware
     middleware = AccessMiddleware()
-    
+
     # Set admin IDs to include our user
-    with patch("wispr_bot.middlewares.access.config") as mock_config:
-        mock_config.admin_user_ids = {123456789}  # Match our mock user ID
-        
+    with patch("wispr_bot.middlewares.access._admin_ids", frozenset({123456789})):
+
         # Call middleware
         await middleware(handler, mock_message, data)
-        
+
         # Verify handler WAS called (user is admin)
         handler.assert_called_once()
-        
-        # Verify create_or_update_user was called
-        mock_db.create_or_update_user.assert_called_once()
-        
-        # Get the user that was created
-        created_user = mock_db.create_or_update_user.call_args[0][0]
-        assert created_user.telegram_id == mock_message.from_user.id
-        assert created_user.username == mock_message.from_user.username
-        assert created_user.is_allowed is True  # Admin should be auto-allowed 
\ No newline at end of file
+
+        # The first event creates the users row so later /setapikey and
+        # /setmodel updates have a row to hit
+        mock_db.upsert_user_returning.assert_called_once()
+        assert mock_db.upsert_user_returning.call_args[1]["is_allowed"] is True
+        assert data["user"].username == mock_message.from_user.username
+        assert data["user"].is_allowed is True  # Admin should be auto-allowed
+
+
+@pytest.mark.asyncio
+async def test_middleware_user_cache_hit(mock_message, mock_user, mock_db):
+    """Test that repeated events from the same user skip the DB."""
+    mock_user.is_allowed = True
+    mock_db.upsert_user_returning.return_value = mock_user
+
+    handler = AsyncMock()
+    middleware = AccessMiddleware()
+
+    # First call populates the cache, second call should not hit the DB
+    await middleware(handler, mock_message, {})
+    await middleware(handler, mock_message, {})
+
+    mock_db.upsert_user_returning.assert_called_once()
+    assert handler.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_middleware_batches_concurrent_lookups(mock_message, mock_user, mock_db):
+    """Test that concurrent events from different users share one query."""
+    import asyncio
+    import copy
+
+    other_message = copy.copy(mock_message)
+    other_message.from_user = type(mock_message.from_user)()
+    other_message.from_user.id = 987654321
+    other_message.from_user.username = "other_user"
+    other_message.from_user.first_name = "Other"
+    other_message.from_user.last_name = "User"
+
+    other_user = User(telegram_id=987654321, username="other_user", is_allowed=True)
+    mock_user.is_allowed = True
+    mock_db.get_users_by_ids.return_value = [mock_user, other_user]
+
+    handler = AsyncMock()
+    middleware = AccessMiddleware()
+
+    await asyncio.gather(
+        middleware(handler, mock_message, {}),
+        middleware(handler, other_message, {}),
+    )
+
+    # Both lookups were coalesced into a single batched query
+    mock_db.get_users_by_ids.assert_called_once()
+    assert sorted(mock_db.get_users_by_ids.call_args[0][0]) == [123456789, 987654321]
+    assert handler.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_loader_load_during_inflight_batch(mock_db):
+    """A lookup arriving while a batch query is mid-await still resolves."""
+    from ..middlewares.access import UserLoader
+
+    loader = UserLoader(window=0.001)
+    first_query_started = asyncio.Event()
+    release_first_query = asyncio.Event()
+    user_a = User(telegram_id=1, username="a", is_allowed=True)
+    user_b = User(telegram_id=2, username="b", is_allowed=True)
+
+    async def slow_get_users(ids):
+        if 1 in ids:
+            first_query_started.set()
+            await release_first_query.wait()
+            return [user_a]
+        return [user_b]
+
+    mock_db.get_users_by_ids.side_effect = slow_get_users
+
+    task_a = asyncio.create_task(loader.load(1))
+    await first_query_started.wait()
+
+    # The first batch has swapped out _pending and is awaiting the DB;
+    # this lookup must schedule its own flush instead of being orphaned
+    result_b = await asyncio.wait_for(loader.load(2), timeout=1)
+    release_first_query.set()
+    result_a = await asyncio.wait_for(task_a, timeout=1)
+
+    assert result_a is user_a
+    assert result_b is user_b
+    assert mock_db.get_users_by_ids.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_middleware_cache_invalidation(mock_message, mock_user, mock_db):
+    """Test that invalidate_user forces a fresh DB read."""
+    mock_user.is_allowed = True
+    mock_db.upsert_user_returning.return_value = mock_user
+
+    handler = AsyncMock()
+    middleware = AccessMiddleware()
+
+    await middleware(handler, mock_message, {})
+    AccessMiddleware.invalidate_user(mock_message.from_user.id)
+    await middleware(handler, mock_message, {})
+
+    assert mock_db.upsert_user_returning.call_count == 2
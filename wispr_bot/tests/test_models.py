@@ -16,8 +16,8 @@ def test_user_model():
     assert user.is_allowed is False
     assert user.openai_api_key is None
     assert user.preferred_model is None
-    assert isinstance(user.created_at, datetime)
-    assert isinstance(user.last_active, datetime)
+    assert user.created_at is None  # Stamped by the DB, not in Python
+    assert user.last_active is None
     
     # Test with all values provided
     user = User(
@@ -65,7 +65,7 @@ def test_chat_message_model():
     msg = ChatMessage(role="user", content="Hello")
     assert msg.role == "user"
     assert msg.content == "Hello"
-    assert isinstance(msg.timestamp, datetime)
+    assert msg.timestamp is None  # Stamped by the DB, not in Python
     
     # Test with all values provided
     timestamp = datetime(2023, 1, 1, 12, 0, 0)
@@ -89,8 +89,8 @@ def test_chat_model():
     assert chat.title == "Test Chat"
     assert chat.model == "gpt-3.5-turbo"
     assert chat.messages == []
-    assert isinstance(chat.created_at, datetime)
-    assert isinstance(chat.updated_at, datetime)
+    assert chat.created_at is None  # Stamped by the DB, not in Python
+    assert chat.updated_at is None
     assert chat.system_prompt is None
     
     # Test with all values and messages
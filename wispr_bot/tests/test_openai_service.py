@@ -1,149 +1,183 @@
+import asyncio
+
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
 
+from ..services import openai_service
 from ..services.openai_service import OpenAIService
 from ..config import config
 
 
-@pytest.mark.asyncio
+@pytest.fixture(autouse=True)
+def _clear_service_caches():
+    """Isolate tests from the module-level caches and stub the SDK client.
+
+    AsyncOpenAI is replaced with a factory of distinct mocks so tests can
+    assert per-key sharing without real credentials.
+    """
+    with patch.object(
+        openai_service, "AsyncOpenAI", MagicMock(side_effect=lambda **kw: MagicMock())
+    ):
+        openai_service._sdk_clients.clear()
+        openai_service._response_cache.clear()
+        openai_service._valid_keys.clear()
+        yield
+    openai_service._sdk_clients.clear()
+    openai_service._response_cache.clear()
+    openai_service._valid_keys.clear()
+
+
+def _post_payload(session) -> dict:
+    """Extract the JSON payload of the last session.post call."""
+    return session.post.call_args[1]["json"]
+
+
 async def test_openai_service_init():
-    """Test OpenAIService initialization."""
-    # Test with default API key
-    with patch("openai.AsyncOpenAI") as mock_openai:
-        service = OpenAIService()
-        mock_openai.assert_called_once_with(api_key=config.openai_api_key)
-        assert service.api_key == config.openai_api_key
-    
-    # Test with custom API key
+    """Test OpenAIService initialization and per-key client sharing."""
+    # Default API key comes from config
+    service = OpenAIService()
+    assert service.api_key == config.openai_api_key
+
+    # Custom API key is kept, and the SDK client is shared per key
     custom_key = "sk-custom-key"
-    with patch("openai.AsyncOpenAI") as mock_openai:
-        service = OpenAIService(api_key=custom_key)
-        mock_openai.assert_called_once_with(api_key=custom_key)
-        assert service.api_key == custom_key
+    service_a = OpenAIService(api_key=custom_key)
+    service_b = OpenAIService(api_key=custom_key)
+    assert service_a.api_key == custom_key
+    assert service_a.client is service_b.client
 
 
-@pytest.mark.asyncio
 async def test_update_api_key():
     """Test updating API key."""
-    with patch("openai.AsyncOpenAI") as mock_openai:
-        service = OpenAIService()
-        mock_openai.reset_mock()
-        
-        # Update API key
-        new_key = "sk-new-key"
-        service.update_api_key(new_key)
-        
-        # Check if client was reinitialized
-        mock_openai.assert_called_once_with(api_key=new_key)
-        assert service.api_key == new_key
-
-
-@pytest.mark.asyncio
-async def test_generate_response_success():
+    service = OpenAIService()
+
+    new_key = "sk-new-key"
+    service.update_api_key(new_key)
+
+    assert service.api_key == new_key
+    assert service.client is OpenAIService(api_key=new_key).client
+
+
+async def test_generate_response_success(openai_http_factory):
     """Test successful generation of responses."""
     messages = [
         {"role": "system", "content": "You are a helpful assistant."},
         {"role": "user", "content": "Hello!"}
     ]
-    
-    # Mock response from OpenAI
-    mock_resp = MagicMock()
-    mock_resp.choices = [MagicMock()]
-    mock_resp.choices[0].message.content = "Hello! How can I help you today?"
-    
-    # Create mock client
-    mock_client = AsyncMock()
-    mock_client.chat.completions.create = AsyncMock(return_value=mock_resp)
-    
-    with patch("openai.AsyncOpenAI", return_value=mock_client):
+
+    session = openai_http_factory("Hello! How can I help you today?")
+    with patch.object(openai_service, "_get_http_session", return_value=session):
         service = OpenAIService()
         response = await service.generate_response(messages, model="gpt-3.5-turbo")
-        
+
         # Verify response
         assert response == "Hello! How can I help you today?"
-        
+
         # Verify API call
-        mock_client.chat.completions.create.assert_called_once()
-        call_args = mock_client.chat.completions.create.call_args[1]
-        assert call_args["model"] == "gpt-3.5-turbo"
-        assert call_args["messages"] == messages
+        session.post.assert_called_once()
+        payload = _post_payload(session)
+        assert payload["model"] == "gpt-3.5-turbo"
+        assert payload["messages"][-1] == {"role": "user", "content": "Hello!"}
+
+
+async def test_generate_response_cached(openai_http_factory):
+    """Identical requests are answered from the cache without a second call."""
+    messages = [{"role": "user", "content": "Same question"}]
+
+    session = openai_http_factory("Cached answer")
+    with patch.object(openai_service, "_get_http_session", return_value=session):
+        service = OpenAIService()
+        first = await service.generate_response(messages, model="gpt-3.5-turbo")
+        second = await service.generate_response(messages, model="gpt-3.5-turbo")
+
+        assert first == second == "Cached answer"
+        session.post.assert_called_once()
+
+
+async def test_generate_response_cancelled_leader_not_cached(openai_http_factory):
+    """Cancelling an in-flight request must not leave a pending cache entry."""
+    messages = [{"role": "user", "content": "Cancel me"}]
+
+    request_started = asyncio.Event()
+    hang = asyncio.Event()
+
+    async def _hang_forever(*args, **kwargs):
+        request_started.set()
+        await hang.wait()
+
+    hanging_session = MagicMock()
+    hanging_session.post = MagicMock(return_value=MagicMock(
+        __aenter__=AsyncMock(side_effect=_hang_forever),
+        __aexit__=AsyncMock(return_value=False),
+    ))
+
+    with patch.object(openai_service, "_get_http_session", return_value=hanging_session):
+        service = OpenAIService()
+        leader = asyncio.create_task(service.generate_response(messages))
+        await request_started.wait()
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+
+    # The cache entry is gone, so a retry makes its own call and resolves
+    session = openai_http_factory("Fresh answer")
+    with patch.object(openai_service, "_get_http_session", return_value=session):
+        result = await asyncio.wait_for(service.generate_response(messages), timeout=1)
+        assert result == "Fresh answer"
 
 
-@pytest.mark.asyncio
-async def test_generate_response_invalid_model():
+async def test_generate_response_invalid_model(openai_http_factory):
     """Test response generation with an invalid model."""
     messages = [{"role": "user", "content": "Hello!"}]
-    
-    # Mock response
-    mock_resp = MagicMock()
-    mock_resp.choices = [MagicMock()]
-    mock_resp.choices[0].message.content = "Hello there!"
-    
-    # Create mock client
-    mock_client = AsyncMock()
-    mock_client.chat.completions.create = AsyncMock(return_value=mock_resp)
-    
-    with patch("openai.AsyncOpenAI", return_value=mock_client):
-        # Set available models in config
-        with patch.object(config, "available_models", ["gpt-3.5-turbo"]):
+
+    session = openai_http_factory("Hello there!")
+    with patch.object(openai_service, "_get_http_session", return_value=session):
+        with patch.object(config, "available_models_set", frozenset({"gpt-3.5-turbo"})):
             with patch.object(config, "default_model", "gpt-3.5-turbo"):
                 service = OpenAIService()
-                
-                # Try with invalid model
-                response = await service.generate_response(messages, model="invalid-model")
-                
+                await service.generate_response(messages, model="invalid-model")
+
                 # Verify default model was used
-                call_args = mock_client.chat.completions.create.call_args[1]
-                assert call_args["model"] == "gpt-3.5-turbo"
+                assert _post_payload(session)["model"] == "gpt-3.5-turbo"
 
 
-@pytest.mark.asyncio
-async def test_generate_response_errors():
+async def test_generate_response_errors(openai_http_factory):
     """Test error handling in generate_response."""
     messages = [{"role": "user", "content": "Hello!"}]
-    
-    # Test rate limit error
-    with patch("openai.AsyncOpenAI") as mock_openai_class:
-        mock_client = AsyncMock()
-        mock_client.chat.completions.create = AsyncMock(
-            side_effect=Exception("Rate limit exceeded")
-        )
-        mock_openai_class.return_value = mock_client
-        
+
+    # Connection error surfaces as a user-facing message
+    session = MagicMock()
+    session.post = MagicMock(side_effect=Exception("boom"))
+    with patch.object(openai_service, "_get_http_session", return_value=session):
         service = OpenAIService()
         response = await service.generate_response(messages)
-        
-        # Verify error message
-        assert "Error connecting to OpenAI" in response
+        assert "Ошибка соединения с OpenAI" in response
+
+    # Rate-limit status maps to the canned rate-limit message
+    session = openai_http_factory(status=429)
+    with patch.object(openai_service, "_get_http_session", return_value=session):
+        service = OpenAIService()
+        response = await service.generate_response(
+            [{"role": "user", "content": "Again"}]
+        )
+        assert response == openai_service._ERR_RATE_LIMIT
 
 
-@pytest.mark.asyncio
-async def test_validate_api_key_valid():
+async def test_validate_api_key_valid(openai_http_factory):
     """Test validation of valid API key."""
-    # Mock successful models.list call
-    mock_client = AsyncMock()
-    mock_client.models.list = AsyncMock()
-    
-    with patch("openai.AsyncOpenAI", return_value=mock_client):
+    session = openai_http_factory(status=200)
+    with patch.object(openai_service, "_get_http_session", return_value=session):
         service = OpenAIService()
         valid = await service.validate_api_key("sk-valid-key")
-        
-        # Verify validation result
+
         assert valid is True
-        mock_client.models.list.assert_called_once()
+        session.get.assert_called_once()
 
 
-@pytest.mark.asyncio
-async def test_validate_api_key_invalid():
+async def test_validate_api_key_invalid(openai_http_factory):
     """Test validation of invalid API key."""
-    # Mock failed models.list call
-    mock_client = AsyncMock()
-    mock_client.models.list = AsyncMock(side_effect=Exception("Invalid API key"))
-    
-    with patch("openai.AsyncOpenAI", return_value=mock_client):
+    session = openai_http_factory(status=401)
+    with patch.object(openai_service, "_get_http_session", return_value=session):
         service = OpenAIService()
         valid = await service.validate_api_key("sk-invalid-key")
-        
-        # Verify validation result
+
         assert valid is False
-        mock_client.models.list.assert_called_once() 
\ No newline at end of file
+        session.get.assert_called_once()
@@ -2,11 +2,21 @@ import sys
 from loguru import logger
 from ..config import config
 
-# Configure logger
+# Configure logger. enqueue=True moves formatting and the blocking
+# write() into a background thread, so a log call from the event loop
+# costs only a queue put instead of disk/stream I/O.
+# backtrace/diagnose включаются только на DEBUG: обход фреймов и repr
+# локальных переменных (включая длинные списки сообщений) на каждом
+# logger.error с исключением — штатный путь при ошибках API — в проде
+# слишком дорогие.
+_debug = config.log_level == "DEBUG"
 logger.remove()
 logger.add(
     sys.stderr,
     level=config.log_level,
+    enqueue=True,
+    backtrace=_debug,
+    diagnose=_debug,
     format="<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level: <8}</level> | <cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>",
 )
 logger.add(
@@ -14,6 +24,9 @@ logger.add(
     rotation="10 MB",
     retention="1 week",
     level=config.log_level,
+    enqueue=True,
+    backtrace=_debug,
+    diagnose=_debug,
     format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {name}:{function}:{line} - {message}",
 )
 
@@ -0,0 +1,40 @@
+"""In-flight request guard for chat message processing.
+
+The active chat itself lives in FSM state (the dispatcher's storage),
+so this module only tracks which users have a request currently being
+streamed. The storage is process-local today, but the helpers are async
+and mirror an atomic SETNX-with-TTL, so a Redis backend can be dropped
+in for multi-worker deployments without touching the call sites.
+"""
+
+import time
+from typing import Dict
+
+# user_id -> monotonic deadline; guards against duplicate OpenAI calls
+# while a previous request is still streaming
+_processing: Dict[int, float] = {}
+
+# Processing marks expire on their own so a crashed task can never lock
+# a user out permanently
+PROCESSING_TTL = 120.0
+
+
+async def mark_processing(user_id: int) -> bool:
+    """Atomically mark the user as having a request in flight.
+
+    Returns False if a non-expired mark already exists. The check and
+    set happen without an await point in between, so concurrent events
+    for the same user cannot both pass — this replaces the racy
+    "check membership, then add" pattern.
+    """
+    now = time.monotonic()
+    deadline = _processing.get(user_id)
+    if deadline is not None and deadline > now:
+        return False
+    _processing[user_id] = now + PROCESSING_TTL
+    return True
+
+
+async def clear_processing(user_id: int) -> None:
+    """Release the user's in-flight mark."""
+    _processing.pop(user_id, None)